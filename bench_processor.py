@@ -0,0 +1,55 @@
+"""
+Benchmark the Deaths counterfactual against the former groupby.apply implementation.
+
+Run from the project folder once the aggregate cache has been built by main.py:
+
+    python bench_processor.py [YEAR] [BENCHMARK]
+"""
+import sys
+import time
+import numpy as np
+from data_manager import AggregateStore, DataManager
+from processor import Processor
+
+
+def legacy_counterfactual_cf(final_data, benchmark, gpby):
+    """The per-group Python callback that _counterfactual_cf replaced."""
+    return (
+        final_data.loc[final_data[benchmark]]
+        .groupby(gpby, observed=True)
+        .apply(lambda x: np.nanmean(x['Deaths Rate'] / x['Prevalence Rate']))
+        .rename("Counterfactual CF")
+    )
+
+
+def best_of(func, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    year = int(sys.argv[1]) if len(sys.argv) > 1 else 2021
+    benchmark = sys.argv[2] if len(sys.argv) > 2 else 'regional_benchmark'
+    gpby = ['Sex', 'Age', 'Cause'] + (['region'] if benchmark == 'regional_benchmark' else [])
+
+    view = AggregateStore().partition(year)
+    data = DataManager.merge_regional_le(view.load(Processor.source_measures('Deaths'), Processor.COLUMNS), view.regional_le())
+    final_data = Processor._deaths_rates(data)
+    print(f'{len(final_data)} Deaths rows, {benchmark}, {year}')
+
+    legacy_time, legacy = best_of(lambda: legacy_counterfactual_cf(final_data, benchmark, gpby))
+    vectorized_time, vectorized = best_of(lambda: Processor._counterfactual_cf(final_data, benchmark, gpby))
+    legacy = legacy.reindex(vectorized.index)
+    equal = len(legacy) == len(vectorized) and np.allclose(legacy, vectorized, rtol=1e-12, atol=0, equal_nan=True)
+
+    print(f'groupby.apply:   {legacy_time:.3f}s')
+    print(f'grouped mean:    {vectorized_time:.3f}s ({legacy_time / vectorized_time:.1f}x)')
+    print(f'results equal:   {equal}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Check that the burden cube matches the pandas Processor on the cached years.
+
+The check runs twice, on the cached rows as they are and with the Prevalence Rate of one
+regional benchmark location set to zero. Its Deaths ratio is then infinite, which must only
+reach the Counterfactual CF of its own region, as in the groupby mean of the pandas path.
+
+Run from the project folder once the aggregate cache has been built by main.py:
+
+    python check_cube.py [BENCHMARK]
+"""
+import sys
+import tempfile
+import pandas as pd
+from cube import BurdenCube
+from data_manager import AggregateStore, DataManager
+from processor import Processor
+from utils import regional_life_expectancy
+
+MEASURES = ['DALYs (Disability-Adjusted Life Years)',
+            'YLDs (Years Lived with Disability)',
+            'Deaths',
+            'YLLs (Years of Life Lost)']
+
+
+def check_parity(data, years, regional_le, benchmark, rtol=1e-9):
+    """Compare BurdenCube with the pandas Processor on long-format rows; raises on any mismatch."""
+    expected = Processor.process_measures(DataManager.merge_regional_le(data, regional_le), MEASURES, benchmark)
+    with tempfile.TemporaryDirectory() as path:
+        cube = BurdenCube.build(data, path)
+        result = pd.concat({year: pd.concat([cube.process_measure(measure, year, regional_le.loc[year], benchmark)
+                                             for measure in MEASURES], axis=1)
+                            for year in years}, names=['Year']).sort_index()
+    # The index labels are compared as strings, as the two paths build different categoricals
+    labels = {key: str for key in Processor.KEYS}
+    result = result.reindex(columns=expected.columns).reset_index().astype(labels)
+    expected = expected.reset_index().astype(labels)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=rtol, check_dtype=False)
+    return True
+
+
+def main():
+    benchmark = sys.argv[1] if len(sys.argv) > 1 else 'regional_benchmark'
+    store = AggregateStore()
+    years = store.years()
+    regional_le = regional_life_expectancy(years, locations=store.codebook.categories['Location'])
+    data = store.read(years)
+
+    # A benchmark location of one region, with a zero Prevalence Rate in every row
+    flagged = regional_le[regional_le['regional_benchmark']].index.get_level_values('Location')
+    location = next(location for location in data['Location'].unique() if location in set(flagged))
+    zero_rate = data.copy()
+    zero_rate.loc[(zero_rate['Location'] == location) & (zero_rate['Measure'] == 'Prevalence')
+                  & (zero_rate['Metric'] == 'Rate'), 'Value'] = 0.0
+
+    print(f'{benchmark}, years {years}')
+    print(f'results equal:                   {check_parity(data, years, regional_le, benchmark)}')
+    print(f'with zero rates of {location}: {check_parity(zero_rate, years, regional_le, benchmark)}')
+
+
+if __name__ == '__main__':
+    main()
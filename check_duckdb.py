@@ -0,0 +1,39 @@
+"""
+Check that the DuckDB engine matches the pandas Processor on the cached years.
+
+Run from the project folder once the aggregate cache has been built by main.py:
+
+    python check_duckdb.py [BENCHMARK]
+"""
+import sys
+import time
+from data_manager import AggregateStore
+from duckdb_engine import DuckDBProcessor, check_parity
+from processor import Processor
+
+MEASURES = ['DALYs (Disability-Adjusted Life Years)',
+            'YLDs (Years Lived with Disability)',
+            'Deaths',
+            'YLLs (Years of Life Lost)']
+
+
+def main():
+    benchmark = sys.argv[1] if len(sys.argv) > 1 else 'regional_benchmark'
+    store = AggregateStore()
+    years = store.years()
+
+    start = time.perf_counter()
+    Processor.process_measures(store.view(years), MEASURES, benchmark)
+    pandas_time = time.perf_counter() - start
+    start = time.perf_counter()
+    DuckDBProcessor(store).process_measures(years, MEASURES, benchmark)
+    duckdb_time = time.perf_counter() - start
+
+    print(f'{benchmark}, years {years}')
+    print(f'pandas:          {pandas_time:.3f}s')
+    print(f'duckdb:          {duckdb_time:.3f}s')
+    print(f'results equal:   {check_parity(store, years, MEASURES, benchmark)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Check that the benchmark sweep matches process_measures on the default benchmark definitions.
+
+The default definitions are those of utils.regional_life_expectancy, so each of their scenarios
+must equal process_measures under that benchmark, including for the IHME locations spelled
+differently from data/all.csv, which the benchmark tables relabel.
+
+Run from the project folder once the aggregate cache has been built by main.py:
+
+    python check_sweep.py
+"""
+import os
+import pandas as pd
+from data_manager import AggregateStore
+from processor import Processor
+from resolver import LocationResolver
+from utils import DATA_FOLDER, remap
+
+MEASURES = ['DALYs (Disability-Adjusted Life Years)',
+            'YLDs (Years Lived with Disability)',
+            'Deaths',
+            'YLLs (Years of Life Lost)']
+DEFAULT_BENCHMARKS = [
+    {'name': 'global_benchmark', 'scope': 'global', 'threshold': 80},
+    {'name': 'regional_benchmark', 'scope': 'regional', 'percentile': 75},
+]
+
+
+def main():
+    store = AggregateStore()
+    years = store.years()
+    view = store.view(years)
+
+    locations = pd.Index(store.codebook.categories['Location'])
+    resolver = LocationResolver.load(os.path.join(DATA_FOLDER, 'all.csv'), remap)
+    codes = resolver.alpha_3(locations)
+    relabelled = [location for location, code, name in zip(locations, codes, resolver.location_names(codes))
+                  if code is not None and location != name]
+    print(f'years {years}, relabelled locations {relabelled}')
+
+    sweep = Processor.sweep_benchmarks(view, MEASURES, DEFAULT_BENCHMARKS)
+    for benchmark in DEFAULT_BENCHMARKS:
+        expected = Processor.process_measures(view, MEASURES, benchmark['name'])
+        result = sweep.xs(benchmark['name'], level='Scenario')
+        pd.testing.assert_index_equal(result.index, expected.index, exact=False)
+        pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-9, check_index_type=False)
+        rows = expected.index.get_level_values('Location').isin(relabelled).sum()
+        print(f'{benchmark["name"]}: results equal, {rows} rows of relabelled locations')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import json
+import os
+import pandas as pd
+from utils import DATA_FOLDER
+
+CODEBOOK_FILE = os.path.join(DATA_FOLDER, 'codebook.json')
+
+
+class Codebook:
+    """
+    Shared categorical encoding of the dimension columns.
+
+    Every dimension maps to a sorted list of labels, so frames encoded with the same codebook
+    join and group on integer codes, and sort exactly as their string labels would. Labels only
+    turn back into strings at the output edges, when results are written out.
+    """
+    DIMENSIONS = ['Location', 'Sex', 'Age', 'Cause', 'Measure', 'Metric', 'region']
+
+    def __init__(self, categories=None):
+        categories = categories or {}
+        self.categories = {dim: sorted(categories.get(dim, [])) for dim in self.DIMENSIONS}
+
+    @classmethod
+    def load(cls, path=CODEBOOK_FILE):
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path=CODEBOOK_FILE):
+        with open(path, 'w') as f:
+            json.dump(self.categories, f, indent=1)
+
+    def update(self, data):
+        """Add the labels of `data` not in the codebook yet."""
+        for dim in self.DIMENSIONS:
+            if dim in data.columns:
+                labels = set(self.categories[dim]).union(data[dim].dropna().unique())
+                self.categories[dim] = sorted(labels)
+        return self
+
+    def dtype(self, dim):
+        return pd.CategoricalDtype(self.categories[dim])
+
+    def encode(self, data):
+        """
+        Return `data` with its dimension columns as codebook categoricals.
+
+        Unseen labels are added first, which changes the dtypes. Frames that will be joined
+        together should be encoded once the codebook is complete.
+        """
+        dims = [dim for dim in self.DIMENSIONS if dim in data.columns]
+        unseen = any(not set(data[dim].dropna().unique()) <= set(self.categories[dim]) for dim in dims)
+        if unseen:
+            self.update(data)
+        return data.astype({dim: self.dtype(dim) for dim in dims})
@@ -0,0 +1,185 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from utils import DATA_FOLDER
+
+CUBE_FOLDER = os.path.join(DATA_FOLDER, 'burden_cube')
+
+
+class BurdenCube:
+    """
+    Dense, memory-mapped array of the burden data with one axis per dimension.
+
+    Year, Measure and Metric come first, so each (year, measure, metric) slab is a
+    contiguous Location × Sex × Age × Cause block on disk. Missing rows are NaN cells, and a
+    boolean array without the Metric axis records which rows exist, as rows may report NaN.
+    The arrays live in plain .npy files opened with mmap_mode='r', so any number of
+    processes can open the cube and share the same pages without copying it.
+    """
+    AXES = ['Year', 'Measure', 'Metric', 'Location', 'Sex', 'Age', 'Cause']
+
+    def __init__(self, values, coords, reported):
+        self.values = values
+        self.coords = coords
+        self.reported = reported
+        self.lookup = {axis: {label: i for i, label in enumerate(labels)} for axis, labels in coords.items()}
+
+    @classmethod
+    def build(cls, data, path=CUBE_FOLDER):
+        """
+        Materialize a long-format aggregate, with a Year column as read from AggregateStore, as a cube.
+
+        Args:
+            data (pd.DataFrame): Rows of Year, Measure, Metric, Location, Sex, Age, Cause and Value.
+            path (str): Folder receiving values.npy, reported.npy and coords.json.
+        """
+        os.makedirs(path, exist_ok=True)
+        coords = {axis: sorted(pd.unique(data[axis].dropna()).tolist()) for axis in cls.AXES}
+        codes = tuple(
+            pd.Categorical(data[axis], categories=coords[axis]).codes for axis in cls.AXES
+        )
+        shape = tuple(len(coords[axis]) for axis in cls.AXES)
+        values = np.lib.format.open_memmap(os.path.join(path, 'values.npy'), mode='w+', dtype='float64', shape=shape)
+        values[:] = np.nan
+        values[codes] = data['Value'].to_numpy(dtype='float64')
+        values.flush()
+        reported = np.lib.format.open_memmap(os.path.join(path, 'reported.npy'), mode='w+', dtype='bool',
+                                             shape=shape[:2] + shape[3:])
+        reported[:] = False
+        reported[codes[:2] + codes[3:]] = True
+        reported.flush()
+        with open(os.path.join(path, 'coords.json'), 'w') as f:
+            json.dump({axis: [int(x) if axis == 'Year' else x for x in labels] for axis, labels in coords.items()}, f)
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path=CUBE_FOLDER):
+        with open(os.path.join(path, 'coords.json')) as f:
+            coords = json.load(f)
+        values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        reported = np.load(os.path.join(path, 'reported.npy'), mmap_mode='r')
+        return cls(values, coords, reported)
+
+    def slab(self, year, measure, metric):
+        """Location × Sex × Age × Cause block of one year, measure and metric."""
+        return np.asarray(self.values[
+            self.lookup['Year'][year], self.lookup['Measure'][measure], self.lookup['Metric'][metric]
+        ])
+
+    def reported_slab(self, year, measure):
+        """Location × Sex × Age × Cause block of the rows one year and measure has."""
+        return np.asarray(self.reported[self.lookup['Year'][year], self.lookup['Measure'][measure]])
+
+    def _benchmark_axes(self, regional_le, benchmark):
+        """
+        Per-location benchmark flags and group codes along the Location axis.
+
+        Locations missing from the life expectancy table get group -1 and drop out, as they do
+        in the inner merge of the pandas path; so do locations without a region when benchmarking
+        within regions.
+        """
+        le = regional_le[~regional_le.index.duplicated()].reindex(self.coords['Location'])
+        in_le = le[benchmark].notna().to_numpy()
+        flags = le[benchmark].fillna(False).to_numpy(dtype=bool)
+        regions = pd.Categorical(le['region'])
+        if benchmark == 'regional_benchmark':
+            groups = np.where(in_le, regions.codes, -1)
+        else:
+            groups = np.where(in_le, 0, -1)
+        return flags, groups, regions
+
+    @staticmethod
+    def _group_mean(values, members, groups):
+        """
+        Mean of `values` over the member locations of each group, broadcast back to every location.
+
+        NaN values are skipped like pandas' mean, and an infinite value only reaches the mean of its
+        own group, as each group is summed over its own cells. Also returns whether each location's
+        group has any member rows at all, which is what decides whether the groupby in the pandas
+        path has the group.
+        """
+        n_groups = max(int(groups.max()) + 1, 1)
+        cells = int(np.prod(values.shape[1:]))
+        members = members & (groups >= 0)[:, None, None, None]
+        safe = np.maximum(groups, 0).astype('int64')
+        # One bin per (group, Sex, Age, Cause) cell; locations outside every group only add zero weights
+        flat = (safe[:, None] * cells + np.arange(cells)[None, :]).ravel()
+        valid = members & ~np.isnan(values)
+        size = n_groups * cells
+        totals = np.bincount(flat, weights=np.where(valid, values, 0.0).ravel(), minlength=size)
+        counts = np.bincount(flat, weights=valid.ravel(), minlength=size)
+        present = np.bincount(flat, weights=members.ravel(), minlength=size) > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (totals / counts).reshape((n_groups,) + values.shape[1:])
+        present = present.reshape((n_groups,) + values.shape[1:])
+        return means[safe], present[safe] & (groups >= 0)[:, None, None, None]
+
+    def _frame(self, mask, columns, regions):
+        """Long-format result over the cells in `mask`, indexed like Processor's output."""
+        loc, sex, age, cause = np.nonzero(mask)
+        index = pd.MultiIndex.from_arrays([
+            pd.Categorical.from_codes(loc, self.coords['Location']),
+            pd.Categorical.from_codes(sex, self.coords['Sex']),
+            pd.Categorical.from_codes(age, self.coords['Age']),
+            pd.Categorical.from_codes(cause, self.coords['Cause']),
+            pd.Categorical.from_codes(regions.codes[loc], regions.categories),
+        ], names=['Location', 'Sex', 'Age', 'Cause', 'region'])
+        return pd.DataFrame({name: values[mask] for name, values in columns.items()}, index=index)
+
+    def process_measure(self, measure, year, regional_le, benchmark):
+        """
+        Counterfactual avertable burden of one measure and year, as array reductions over the cube.
+
+        Args:
+            measure (str): The measure to process (e.g., 'Deaths', 'DALYs').
+            year (int): The year to process.
+            regional_le (pd.DataFrame): Output of load_regional_life_expectancy for the year.
+            benchmark (str): 'global_benchmark' or 'regional_benchmark'.
+
+        Returns:
+            pd.DataFrame: The same columns as Processor.process_measure.
+        """
+        flags, groups, regions = self._benchmark_axes(regional_le, benchmark)
+        in_le = (groups >= 0)[:, None, None, None]
+        bench = flags[:, None, None, None]
+        if measure == 'Deaths':
+            return self._process_deaths(year, bench, in_le, groups, regions)
+        return self._process_other_measure(measure, year, bench, in_le, groups, regions)
+
+    def _process_deaths(self, year, bench, in_le, groups, regions):
+        deaths, deaths_rate = self.slab(year, 'Deaths', 'Number'), self.slab(year, 'Deaths', 'Rate')
+        prevalence, prevalence_rate = self.slab(year, 'Prevalence', 'Number'), self.slab(year, 'Prevalence', 'Rate')
+        # Rows of both measures, NaN values included, like the inner merge of the pandas path
+        rows = self.reported_slab(year, 'Deaths') & self.reported_slab(year, 'Prevalence')
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = deaths_rate / prevalence_rate
+        cf, present = self._group_mean(ratio, rows & bench & in_le, groups)
+
+        with np.errstate(invalid='ignore'):
+            mask = rows & in_le & present & (np.fmin(prevalence, deaths) > 10)
+        adjusted = prevalence * cf
+        avertable = deaths - adjusted
+        with np.errstate(invalid='ignore'):
+            avertable = np.where(avertable < 0, 0, avertable)
+        columns = {'Deaths': deaths, 'Counterfactual CF': cf, 'Adjusted Deaths': adjusted, 'Avertable Deaths': avertable}
+        return self._frame(mask, columns, regions)
+
+    def _process_other_measure(self, measure, year, bench, in_le, groups, regions):
+        number, rate = self.slab(year, measure, 'Number'), self.slab(year, measure, 'Rate')
+        with np.errstate(invalid='ignore'):
+            kept = (number > 10) & in_le
+        hic_mean_rate, present = self._group_mean(rate, kept & bench, groups)
+
+        mask = kept & present
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = np.minimum(hic_mean_rate / rate, 1)
+        adjusted = number * ratio
+        columns = {
+            measure: number,
+            f'AdjustRatio {measure}': ratio,
+            f'Adjusted {measure}': adjusted,
+            f'Avertable {measure}': number - adjusted,
+        }
+        return self._frame(mask, columns, regions)
@@ -4,6 +4,9 @@ import plotly.express as px
 import pandas as pd
 import os
 import warnings
+from codebook import Codebook
+from query_store import QueryStore
+from figure_cache import FigureCache
 
 # Suppress warnings
 warnings.filterwarnings('ignore')
@@ -13,6 +16,8 @@ DOWNLOAD_FOLDER = '/Users/leo/Downloads/avertableMortality/'
 DATA_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'data')
 YEARS = [2018, 2019, 2020, 2021]
 RESULTS_FILES = [os.path.join(DATA_FOLDER, f'results_aggregatedGDB_{year}.csv') for year in YEARS]
+FIGURE_CACHE_FOLDER = os.path.join(DATA_FOLDER, 'dashboard_cache')
+FIGURE_CACHE_BYTES = 256 * 1024 ** 2
 
 # Load and combine data for all years
 data_frames = []
@@ -24,11 +29,26 @@ for year, file in zip(YEARS, RESULTS_FILES):
     else:
         print(f"File {file} not found!")
 
-combined_data = pd.concat(data_frames, ignore_index=True)
+# Dimension columns are categoricals from the shared codebook, so callbacks filter and group on codes
+combined_data = Codebook.load(os.path.join(DATA_FOLDER, 'codebook.json')).encode(
+    pd.concat(data_frames, ignore_index=True))
+# Sorted by (Cause, Year, Sex, Age), so each callback slices its rows instead of scanning them all
+store = QueryStore(combined_data)
+del combined_data
+YEAR_MIN, YEAR_MAX = int(min(store.labels['Year'])), int(max(store.labels['Year']))
+
+# Figures of repeated selections come from a disk cache shared by all workers, tied to these results files
+figure_cache = FigureCache(FIGURE_CACHE_FOLDER, FIGURE_CACHE_BYTES,
+                           version=[(file, os.path.getmtime(file), os.path.getsize(file)) for file in RESULTS_FILES if os.path.exists(file)])
 
 # Initialize Dash app
 app = dash.Dash(__name__)
 
+@app.server.route('/cache-stats')
+def cache_stats():
+    # Hit and miss counts of the worker that answers, and the size of the shared cache
+    return figure_cache.stats()
+
 # Split long titles into multiple lines
 def split_title(title, max_length=50):
     if len(title) > max_length:
@@ -42,7 +62,7 @@ app.layout = html.Div([
             html.Label("Select Sex:"),
             dcc.Dropdown(
                 id='sex-dropdown',
-                options=[{'label': sex, 'value': sex} for sex in combined_data['Sex'].unique()],
+                options=[{'label': sex, 'value': sex} for sex in store.labels['Sex']],
                 multi=True,
                 placeholder="Select Sex",
                 value=['Female']
@@ -52,7 +72,7 @@ app.layout = html.Div([
             html.Label("Select Age:"),
             dcc.Dropdown(
                 id='age-dropdown',
-                options=[{'label': age, 'value': age} for age in combined_data['Age'].unique()],
+                options=[{'label': age, 'value': age} for age in store.labels['Age']],
                 multi=True,
                 placeholder="Select Age",
                 value=['55+ years']
@@ -62,8 +82,8 @@ app.layout = html.Div([
             html.Label("Select Cause:"),
             dcc.Dropdown(
                 id='cause-dropdown',
-                options=[{'label': cause, 'value': cause} for cause in combined_data['Cause'].unique()],
-                value=combined_data['Cause'].unique()[0],
+                options=[{'label': cause, 'value': cause} for cause in store.labels['Cause']],
+                value=store.labels['Cause'][0],
                 clearable=False
             )
         ], style={'margin-bottom': '5px'}),
@@ -103,11 +123,11 @@ app.layout = html.Div([
                     html.Label("Year Slider:"),
                     dcc.Slider(
                         id='year-slider',
-                        min=int(combined_data['Year'].min()),
-                        max=int(combined_data['Year'].max()),
+                        min=YEAR_MIN,
+                        max=YEAR_MAX,
                         step=1,
-                        value=int(combined_data['Year'].min()),
-                        marks={int(year): str(year) for year in combined_data['Year'].unique()}
+                        value=YEAR_MIN,
+                        marks={int(year): str(year) for year in store.labels['Year']}
                     ),
                     html.Button("Play", id="play-button", n_clicks=0)
                 ], style={'margin-top': '10px'}),
@@ -155,7 +175,7 @@ def toggle_interval(n_clicks, is_disabled):
 )
 def update_year_store(n_intervals, current_year):
     # Increment year on each interval tick
-    next_year = current_year + 1 if current_year < int(combined_data['Year'].max()) else int(combined_data['Year'].min())
+    next_year = current_year + 1 if current_year < YEAR_MAX else YEAR_MIN
     return next_year
     
 
@@ -169,23 +189,14 @@ def update_year_store(n_intervals, current_year):
         Input('year-slider', 'value')
     ]
 )
-
+@figure_cache.memoize
 def update_geomap(selected_sex, selected_age, selected_cause, selected_metric, selected_year):
     # Filter and aggregate data
-    filtered_data = combined_data[
-        (combined_data['Sex'].isin(selected_sex)) &
-        (combined_data['Age'].isin(selected_age)) &
-        (combined_data['Cause'] == selected_cause) &
-        (combined_data['Year'] == selected_year)
-    ]
-    filtered_data = filtered_data.groupby('Location')[selected_metric].sum().reset_index()
+    filtered_data = store.select(selected_cause, [selected_year], selected_sex, selected_age, ['Location', selected_metric])
+    filtered_data = filtered_data.groupby('Location', observed=True)[selected_metric].sum().reset_index()
 
     # Compute global min and max
-    global_data = combined_data[
-        (combined_data['Sex'].isin(selected_sex)) &
-        (combined_data['Age'].isin(selected_age)) &
-        (combined_data['Cause'] == selected_cause)
-    ]
+    global_data = store.select(selected_cause, None, selected_sex, selected_age, [selected_metric])
     global_min = global_data[selected_metric].min()
     global_max = global_data[selected_metric].max()
 
@@ -233,13 +244,10 @@ def update_geomap(selected_sex, selected_age, selected_cause, selected_metric, s
         Input('sex-dropdown', 'value')
     ]
 )
+@figure_cache.memoize
 def update_age_distribution(selected_metric, selected_cause, selected_year, selected_sex):
-    filtered_data = combined_data[
-        (combined_data['Year'] == selected_year) &
-        (combined_data['Cause'] == selected_cause) &
-        (combined_data['Sex'].isin(selected_sex))
-    ]
-    age_distribution = filtered_data.groupby('Age')[selected_metric].sum().reset_index()
+    filtered_data = store.select(selected_cause, [selected_year], selected_sex, None, ['Age', selected_metric])
+    age_distribution = filtered_data.groupby('Age', observed=True)[selected_metric].sum().reset_index()
     fig = px.pie(age_distribution, names='Age', values=selected_metric, title='Distribution by Age Group')
     return fig
 
@@ -252,13 +260,10 @@ def update_age_distribution(selected_metric, selected_cause, selected_year, sele
         Input('sex-dropdown', 'value')
     ]
 )
+@figure_cache.memoize
 def update_top_countries_distribution(selected_metric, selected_cause, selected_year, selected_sex):
-    filtered_data = combined_data[
-        (combined_data['Year'] == selected_year) &
-        (combined_data['Cause'] == selected_cause) &
-        (combined_data['Sex'].isin(selected_sex))
-    ]
-    country_distribution = filtered_data.groupby('Location')[selected_metric].sum().reset_index()
+    filtered_data = store.select(selected_cause, [selected_year], selected_sex, None, ['Location', selected_metric])
+    country_distribution = filtered_data.groupby('Location', observed=True)[selected_metric].sum().reset_index()
     top_countries = country_distribution.nlargest(5, selected_metric)
     other = country_distribution[selected_metric].sum() - top_countries[selected_metric].sum()
     other_row = pd.DataFrame({'Location': ['Other'], selected_metric: [other]})
@@ -279,23 +284,21 @@ def update_top_countries_distribution(selected_metric, selected_cause, selected_
         Input('metric-dropdown', 'value')
     ]
 )
+@figure_cache.memoize
 def update_side_plots(selected_ages, selected_sexes, selected_cause, selected_metric):
-    filtered_data = combined_data[
-        (combined_data['Age'].isin(selected_ages)) &
-        (combined_data['Sex'].isin(selected_sexes)) &
-        (combined_data['Cause'] == selected_cause)
-    ]
+    filtered_data = store.select(selected_cause, None, selected_sexes, selected_ages,
+                                 ['Year', 'Age', 'Sex', 'Location', selected_metric])
 
     # Time Evolution
-    time_evolution = filtered_data.groupby(['Year', 'Age'])[selected_metric].sum().reset_index()
+    time_evolution = filtered_data.groupby(['Year', 'Age'], observed=True)[selected_metric].sum().reset_index()
     time_fig = px.line(time_evolution, x='Year', y=selected_metric, color='Age', title="Time Evolution by Age Group")
 
     # Gender Comparison
-    gender_comparison = filtered_data.groupby(['Year', 'Sex'])[selected_metric].sum().reset_index()
+    gender_comparison = filtered_data.groupby(['Year', 'Sex'], observed=True)[selected_metric].sum().reset_index()
     gender_fig = px.bar(gender_comparison, x='Year', y=selected_metric, color='Sex', barmode='group', title="Gender Comparison Over Time")
 
     # Global Disparity (Variance Proxy)
-    disparity = filtered_data.groupby(['Year', 'Location'])[selected_metric].sum().groupby('Year').var().reset_index()
+    disparity = filtered_data.groupby(['Year', 'Location'], observed=True)[selected_metric].sum().groupby('Year').var().reset_index()
     disparity_fig = px.scatter(disparity, x='Year', y=selected_metric, title="Global Disparity Over Time")
 
     return time_fig, gender_fig, disparity_fig
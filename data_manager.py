@@ -1,34 +1,361 @@
 import os
+import shutil
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
 from tqdm import tqdm
-from utils import DATA_FOLDER, DOWNLOAD_FOLDER, load_regional_life_expectancy
+from utils import DATA_FOLDER, DOWNLOAD_FOLDER, load_regional_life_expectancy, regional_life_expectancy, concat_frames, open_source, remap
+from codebook import Codebook, CODEBOOK_FILE
+from resolver import LocationResolver
+
+AGGREGATED_COLUMNS = ['Measure', 'Location', 'Sex', 'Age', 'Cause', 'Metric', 'Value']
+SOURCE_COLUMNS = {
+    'measure': 'Measure', 'location': 'Location', 'sex': 'Sex', 'age': 'Age', 'cause': 'Cause',
+    'metric': 'Metric', 'val': 'Value', 'year': 'Year', 'lower': 'Lower', 'upper': 'Upper',
+}
 
 class DataManager:
     @staticmethod
     def ensure_data_folder():
         if not os.path.exists(DATA_FOLDER):
             os.mkdir(DATA_FOLDER)
-            zip_files = [f for f in os.listdir(DOWNLOAD_FOLDER) if f.startswith('IHM')]
-            for zip_file in zip_files:
-                with zipfile.ZipFile(os.path.join(DOWNLOAD_FOLDER, zip_file), 'r') as zip_ref:
-                    zip_ref.extractall(DATA_FOLDER)
+
+    @staticmethod
+    def source_files():
+        """
+        List the IHME exports to ingest.
+
+        Extracted CSVs in DATA_FOLDER are returned as paths. CSV members of the IHM* zip
+        archives in DOWNLOAD_FOLDER are returned as (zip path, member) pairs and streamed
+        straight out of the archive, unless a CSV of the same name was already extracted.
+        """
+        csv_files = [
+            os.path.join(DATA_FOLDER, f) for f in sorted(os.listdir(DATA_FOLDER))
+            if f.startswith('IHM') and f.endswith('.csv')
+        ]
+        extracted = {os.path.basename(f) for f in csv_files}
+        zip_files = [f for f in sorted(os.listdir(DOWNLOAD_FOLDER)) if f.startswith('IHM') and f.endswith('.zip')]
+        for zip_file in zip_files:
+            zip_path = os.path.join(DOWNLOAD_FOLDER, zip_file)
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                members = [m for m in zip_ref.namelist() if m.endswith('.csv')]
+            csv_files += [(zip_path, m) for m in members if os.path.basename(m) not in extracted]
+        return csv_files
+
+    @staticmethod
+    def source_id(source):
+        return '::'.join(source) if isinstance(source, tuple) else source
+
+    @staticmethod
+    def source_stat(source):
+        """Size and mtime of a source; for a zip member, its uncompressed size and the archive mtime."""
+        if isinstance(source, tuple):
+            zip_path, member = source
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                size = zip_ref.getinfo(member).file_size
+            return {'size': size, 'mtime': os.path.getmtime(zip_path)}
+        return {'size': os.path.getsize(source), 'mtime': os.path.getmtime(source)}
+
+    @staticmethod
+    def source_hash(source):
+        digest = hashlib.sha256()
+        with open_source(source) as stream:
+            for block in iter(lambda: stream.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def parse_sources(process_file_func, source_files, years, workers=1):
+        """
+        Parse each source file for the years given for it; `years` holds one list per source.
+
+        With workers > 1 the files are parsed across a process pool. Results are collected in
+        source order, so the output is the same whatever the worker count.
+        """
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(process_file_func, source_files, years)
+                return list(tqdm(results, total=len(source_files)))
+        return [process_file_func(file, file_years) for file, file_years in tqdm(zip(source_files, years), total=len(source_files))]
 
     @staticmethod
     def load_or_aggregate_data(aggregated_file, process_file_func, year):
         if aggregated_file not in os.listdir(DATA_FOLDER):
-            csv_files = [
-                os.path.join(DATA_FOLDER, f) for f in os.listdir(DATA_FOLDER)
-                if f.startswith('IHM') and f.endswith('.csv')
-            ]
-            processed_data = (process_file_func(file, year) for file in tqdm(csv_files))
-            aggregated_data = pd.concat(processed_data, ignore_index=True)
-            aggregated_data.columns = ['Measure', 'Location', 'Sex', 'Age', 'Cause', 'Metric', 'Value']
+            processed_data = (process_file_func(file, year) for file in tqdm(DataManager.source_files()))
+            aggregated_data = concat_frames(processed_data)
+            aggregated_data.columns = AGGREGATED_COLUMNS
             aggregated_data.to_csv(os.path.join(DATA_FOLDER, aggregated_file), index=False)
         else:
             aggregated_data = pd.read_csv(os.path.join(DATA_FOLDER, aggregated_file))
-        regional_le = load_regional_life_expectancy(year)
+        regional_agg = DataManager.merge_regional_le(aggregated_data, load_regional_life_expectancy(year))
+        return Codebook.load().encode(regional_agg)
+
+    @staticmethod
+    def merge_regional_le(aggregated_data, regional_le):
+        """Attach region and benchmark flags per Location, or per Year and Location when regional_le is indexed by both."""
+        keys = ['Year', 'Location'] if regional_le.index.nlevels == 2 else ['Location']
         regional_agg = aggregated_data.merge(regional_le[['region','regional_benchmark','global_benchmark']],
-                              left_on=['Location'],
+                              left_on=keys,
                               right_index=True)
         return regional_agg
+
+    @staticmethod
+    def save_results(results, result_file_template):
+        """Write Year-indexed results as one file per year, in one go."""
+        for year, year_results in results.groupby(level='Year'):
+            year_results.droplevel('Year').to_csv(os.path.join(DATA_FOLDER, result_file_template.format(year=year)))
+
+    @staticmethod
+    def location_report(store, years, regional_le, report_file='unmatched_locations.csv'):
+        """
+        Write which IHME locations the join with the benchmarks drops, and which LifeExpectancy.csv
+        countries match nothing, instead of losing them silently.
+        """
+        location_rows = store.read(years, columns=['Location'])['Location'].value_counts()
+        le_names = pd.read_csv(os.path.join(DATA_FOLDER, 'LifeExpectancy.csv'), usecols=['Country Name'])['Country Name']
+        resolver = LocationResolver.load(os.path.join(DATA_FOLDER, 'all.csv'), remap)
+        report = resolver.report(location_rows, regional_le, le_names)
+        report.to_csv(os.path.join(DATA_FOLDER, report_file), index=False)
+        dropped = report[report['source'] == 'IHME']
+        if len(dropped):
+            print(f'{len(dropped)} IHME locations ({dropped["rows"].sum()} rows) have no life expectancy benchmark '
+                  f'and are dropped, see {report_file}')
+        return report
+
+    @staticmethod
+    def stream_results(partitions, result_file_template):
+        """Write Year-indexed results arriving partition by partition, appending to one file per year."""
+        written = set()
+        for results in partitions:
+            for year, year_results in results.groupby(level='Year'):
+                year_results.droplevel('Year').to_csv(os.path.join(DATA_FOLDER, result_file_template.format(year=year)),
+                                                      mode='a' if year in written else 'w', header=year not in written)
+                written.add(year)
+        return sorted(written)
+
+    @staticmethod
+    def load_results(result_file_template, years, columns=None):
+        """Read per-year results files back, indexed by Year and the result keys, with only the given columns."""
+        keys = ['Location', 'Sex', 'Age', 'Cause', 'region']
+        usecols = None if columns is None else keys + list(columns)
+        return pd.concat({
+            year: pd.read_csv(os.path.join(DATA_FOLDER, result_file_template.format(year=year)), usecols=usecols, index_col=keys)
+            for year in years
+        }, names=['Year'])
+
+
+class AggregateStore:
+    """
+    Parquet cache of the aggregated data, partitioned by Year and Measure.
+
+    Dimension columns are stored as dictionary-encoded categoricals, so a warm run
+    reads compact typed columns instead of re-parsing strings from a CSV. On read they
+    are encoded with the shared codebook, which is extended whenever new data is cached.
+
+    Every source file writes its own part files, and a manifest records each source's
+    size, mtime, content hash, and the years and partitions it contributed. Only new or
+    changed sources are parsed when the cache is built again.
+    """
+
+    def __init__(self, path=os.path.join(DATA_FOLDER, 'aggregatedGDB'), codebook_file=CODEBOOK_FILE):
+        self.path = path
+        self.codebook_file = codebook_file
+        self.codebook = Codebook.load(codebook_file)
+        # Parquet readers skip files starting with '_', so the manifest can live in the dataset
+        self.manifest_file = os.path.join(path, '_manifest.json')
+
+    def years(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(int(d.split('=', 1)[1]) for d in os.listdir(self.path) if d.startswith('Year='))
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_file):
+            return {}
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        with open(self.manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    @staticmethod
+    def part_prefix(source_id):
+        return hashlib.sha256(source_id.encode()).hexdigest()[:16]
+
+    def remove_parts(self, source_id):
+        prefix = self.part_prefix(source_id) + '-'
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                if f.startswith(prefix):
+                    os.remove(os.path.join(root, f))
+
+    def plan(self, source_files, years):
+        """
+        Compare the sources with the manifest.
+
+        Returns the years to parse for each source, keyed by source id, and the ids of sources
+        whose cached parts are stale. Size and mtime are checked first; the content hash is only
+        computed when they changed, so touching a file does not trigger a re-parse.
+        """
+        manifest = self.load_manifest()
+        pending, stale = {}, []
+        for source in source_files:
+            source_id = DataManager.source_id(source)
+            entry = manifest.get(source_id)
+            stat = DataManager.source_stat(source)
+            if entry is not None and stat != {'size': entry['size'], 'mtime': entry['mtime']}:
+                if DataManager.source_hash(source) == entry['sha256']:
+                    entry.update(stat)
+                else:
+                    stale.append(source_id)
+                    pending[source_id] = sorted(set(years) | set(entry['years']))
+                    continue
+            cached_years = entry['years'] if entry is not None else []
+            missing = [year for year in years if year not in cached_years]
+            if missing:
+                pending[source_id] = missing
+        current = {DataManager.source_id(source) for source in source_files}
+        stale += [source_id for source_id in manifest if source_id not in current]
+        return manifest, pending, stale
+
+    def build(self, process_file_func, years, workers=1):
+        """Parse only the sources, and years, not cached yet, and add their parts to the store."""
+        if os.path.isdir(self.path) and not os.path.exists(self.manifest_file):
+            # A cache written without a manifest cannot be updated source by source
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+        source_files = DataManager.source_files()
+        manifest, pending, stale = self.plan(source_files, years)
+        for source_id in stale:
+            self.remove_parts(source_id)
+            if source_id not in pending:
+                manifest.pop(source_id)
+        self.save_manifest(manifest)
+        if not pending:
+            return
+
+        parse_files = [source for source in source_files if DataManager.source_id(source) in pending]
+        parse_years = [pending[DataManager.source_id(source)] for source in parse_files]
+        processed_data = DataManager.parse_sources(process_file_func, parse_files, parse_years, workers)
+        regions = pd.read_csv(os.path.join(DATA_FOLDER, 'all.csv'), usecols=['region'])
+        self.codebook.update(regions)
+        for source, file_years, source_data in zip(parse_files, parse_years, processed_data):
+            source_id = DataManager.source_id(source)
+            source_data = source_data.rename(columns=SOURCE_COLUMNS)
+            source_data = self.codebook.update(source_data).encode(source_data)
+            if len(source_data):
+                source_data.to_parquet(self.path, partition_cols=['Year', 'Measure'], index=False,
+                                       basename_template=self.part_prefix(source_id) + '-{i}.parquet')
+            entry = manifest.get(source_id, {'years': [], 'partitions': []})
+            if source_id in stale:
+                entry = {'years': [], 'partitions': []}
+            partitions = source_data[['Year', 'Measure']].drop_duplicates().astype(str)
+            entry['years'] = sorted(set(entry['years']) | set(file_years))
+            entry['partitions'] = sorted(set(entry['partitions']) | {f'{y}/{m}' for y, m in partitions.itertuples(index=False)})
+            entry.update(DataManager.source_stat(source))
+            entry['sha256'] = DataManager.source_hash(source)
+            manifest[source_id] = entry
+            self.save_manifest(manifest)
+        self.codebook.save(self.codebook_file)
+
+    def read(self, years, measures=None, columns=None, locations=None):
+        """Read only the partitions of the given years and measures, and only the given columns and locations."""
+        filters = [('Year', 'in', list(years))]
+        if measures is not None:
+            filters.append(('Measure', 'in', list(measures)))
+        if locations is not None:
+            filters.append(('Location', 'in', list(locations)))
+        data = pd.read_parquet(self.path, filters=filters, columns=columns)
+        if 'Year' in data.columns:
+            data['Year'] = data['Year'].astype('int16')
+        return self.codebook.encode(data)
+
+    def partition(self, year):
+        return AggregatedView(self, [year])
+
+    def view(self, years, regional_le=None):
+        return AggregatedView(self, years, regional_le)
+
+
+class AggregatedView:
+    """
+    Lazy view of cached years, with each year's regional life expectancy benchmarks.
+
+    The loaded frame always has a Year column, which Processor uses as a grouping key. The
+    region and benchmark flags are not merged onto its rows; Processor attaches them from
+    `regional_le` once the rows are pivoted.
+    """
+
+    def __init__(self, store, years, regional_le=None):
+        self.store = store
+        self.years = list(years)
+        # Per-year regional life expectancy indexed by Year and Location, loaded on first use if not given
+        self._regional_le = regional_le
+
+    def regional_le(self):
+        if self._regional_le is None:
+            self._regional_le = regional_life_expectancy(self.years, locations=self.store.codebook.categories['Location'])
+        return self._regional_le
+
+    def load(self, measures=None, columns=None, locations=None):
+        if columns is not None and 'Year' not in columns:
+            columns = list(columns) + ['Year']
+        return self.store.read(self.years, measures, columns, locations)
+
+    def split_locations(self, partitions, measures, path):
+        """
+        Write the rows of `measures` into one folder per partition of locations under `path`,
+        reading every part file of the view once, one file at a time.
+
+        Part files are split by source rather than by Location, so loading a partition of
+        locations from the store reads every part file again. Loading from these folders reads
+        only the partition's own rows.
+
+        Args:
+            partitions (list): Lists of locations; locations in none of them are left out.
+            measures (list): IHME measures to keep.
+            path (str): Empty folder receiving the partitions.
+
+        Returns:
+            list: A LocationPartition per partition, loaded like the view.
+        """
+        partition_of = {location: i for i, locations in enumerate(partitions) for location in locations}
+        dataset = ds.dataset(self.store.path, format='parquet', partitioning='hive')
+        fragments = dataset.get_fragments(filter=ds.field('Year').isin(self.years) & ds.field('Measure').isin(list(measures)))
+        for n, fragment in enumerate(fragments):
+            data = fragment.to_table().to_pandas().assign(**ds.get_partition_keys(fragment.partition_expression))
+            # Partition of each Location code; -1, also at the end for missing codes, when in none
+            lookup = np.array([partition_of.get(label, -1) for label in data['Location'].cat.categories] + [-1])
+            data['Partition'] = lookup[data['Location'].cat.codes.to_numpy()]
+            data = data[data['Partition'] >= 0]
+            if len(data):
+                data.to_parquet(path, partition_cols=['Partition'], index=False, basename_template=f'{n}-{{i}}.parquet')
+        return [LocationPartition(self, os.path.join(path, f'Partition={i}')) for i in range(len(partitions))]
+
+
+class LocationPartition:
+    """The rows of one partition of locations written by AggregatedView.split_locations."""
+
+    def __init__(self, view, path):
+        self.view = view
+        self.path = path
+
+    def load(self, measures=None, columns=None, locations=None):
+        """The rows of the given measures and locations, as AggregatedView.load returns them."""
+        if columns is not None and 'Year' not in columns:
+            columns = list(columns) + ['Year']
+        if not os.path.isdir(self.path):
+            return pd.DataFrame(columns=columns)
+        filters = []
+        if measures is not None:
+            filters.append(('Measure', 'in', list(measures)))
+        if locations is not None:
+            filters.append(('Location', 'in', list(locations)))
+        data = pd.read_parquet(self.path, columns=columns, filters=filters or None)
+        data['Year'] = data['Year'].astype('int16')
+        return self.view.store.codebook.encode(data)
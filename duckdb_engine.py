@@ -0,0 +1,185 @@
+import glob
+import os
+from urllib.parse import unquote
+import pandas as pd
+from processor import Processor
+from utils import SOURCE_DTYPES, read_source, regional_life_expectancy
+
+
+def sql_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def process_file_years_duckdb(file_path, years):
+    """
+    process_file_years on DuckDB: the year filter and the column list are pushed into the CSV scan.
+
+    Zip members are read with pandas, as DuckDB cannot scan inside an archive.
+    """
+    if isinstance(file_path, tuple):
+        df = read_source(file_path, years)
+    else:
+        import duckdb
+        df = duckdb.sql(
+            f"SELECT {', '.join(SOURCE_DTYPES)} FROM read_csv({sql_literal(file_path)}, header = true) "
+            f"WHERE year IN ({', '.join(str(int(year)) for year in years)})"
+        ).df().astype(SOURCE_DTYPES)
+    return df[['measure', 'location', 'sex', 'age', 'cause', 'metric', 'val', 'year']]
+
+
+class DuckDBProcessor:
+    """
+    The counterfactuals of Processor.process_measures as DuckDB queries over the aggregate store.
+
+    Only the part files of the requested years and measures are scanned, and only the columns
+    the query uses are read. The pivot, the benchmark means and the joins run inside DuckDB
+    on all its threads; pandas only receives the final columns.
+
+    NaN values are turned into NULL on read, so DuckDB's aggregates and comparisons skip them
+    the way pandas does. Whether a row was reported is counted from the rows, not from their values.
+    """
+
+    def __init__(self, store, threads=None):
+        import duckdb
+        self.store = store
+        self.con = duckdb.connect()
+        if threads:
+            self.con.execute(f'SET threads = {int(threads)}')
+
+    def partition_files(self, year, measure):
+        """Part files of one Year/Measure partition; pyarrow URL-encodes the partition values."""
+        year_folder = os.path.join(self.store.path, f'Year={year}')
+        if not os.path.isdir(year_folder):
+            return []
+        for folder in os.listdir(year_folder):
+            if folder.startswith('Measure=') and unquote(folder.split('=', 1)[1]) == measure:
+                return sorted(glob.glob(os.path.join(year_folder, folder, '*.parquet')))
+        return []
+
+    def scan(self, years, measures):
+        """SELECT of the Year, keys, Measure, Metric and Value of the given partitions."""
+        scans = []
+        for year in years:
+            for measure in measures:
+                files = self.partition_files(year, measure)
+                if files:
+                    scans.append(
+                        f"SELECT {int(year)} AS Year, {sql_literal(measure)} AS Measure, Location, Sex, Age, Cause, Metric, "
+                        f"CASE WHEN isnan(Value) THEN NULL ELSE Value END AS Value "
+                        f"FROM read_parquet([{', '.join(sql_literal(f) for f in files)}])"
+                    )
+        if not scans:
+            raise ValueError(f'No cached partitions for {measures} in {years}')
+        return ' UNION ALL '.join(scans)
+
+    def process_measures(self, years, measures, benchmark, regional_le=None):
+        """
+        Process several measures, with the output of Processor.process_measures.
+
+        Args:
+            years (list): The cached years to process.
+            measures (list): The measures to process.
+            benchmark (str): 'global_benchmark' or 'regional_benchmark'.
+            regional_le (pd.DataFrame): Per-year regional life expectancy indexed by Year and
+                Location; loaded like AggregatedView does when not given.
+        """
+        if regional_le is None:
+            regional_le = regional_life_expectancy(years, locations=self.store.codebook.categories['Location'])
+        le = regional_le.rename_axis(['Year', 'Location']).reset_index()
+        le = le[['Year', 'Location', 'region', benchmark]].drop_duplicates(['Year', 'Location'])
+        le = le.astype({'Location': object, 'region': object}).rename(columns={benchmark: 'flag'})
+        self.con.register('le', le)
+        needed = list(dict.fromkeys(m for measure in measures for m in Processor.source_measures(measure)))
+        self.con.execute(f'CREATE OR REPLACE TEMP TABLE src AS {self.scan(years, needed)}')
+
+        gpby = ['Year', 'Sex', 'Age', 'Cause'] + (['region'] if benchmark == 'regional_benchmark' else [])
+        outputs = []
+        for measure in measures:
+            if measure == 'Deaths':
+                query = self._deaths_query(gpby)
+            else:
+                query = self._other_measure_query(measure, gpby)
+            output = self.con.execute(query).df()
+            outputs.append(output.set_index(['Year'] + Processor.KEYS))
+        self.con.unregister('le')
+
+        results = pd.concat(outputs, axis=1)
+        results = self.store.codebook.encode(results.reset_index()).astype({'Year': 'int16'})
+        return results.set_index(['Year'] + Processor.KEYS).sort_index()
+
+    @staticmethod
+    def _deaths_query(gpby):
+        keys = ', '.join(gpby)
+        return f"""
+        WITH rates AS (
+            SELECT Year, Location, Sex, Age, Cause,
+                max(Value) FILTER (WHERE Measure = 'Deaths' AND Metric = 'Number') AS deaths,
+                max(Value) FILTER (WHERE Measure = 'Deaths' AND Metric = 'Rate') AS deaths_rate,
+                max(Value) FILTER (WHERE Measure = 'Prevalence' AND Metric = 'Number') AS prevalence,
+                max(Value) FILTER (WHERE Measure = 'Prevalence' AND Metric = 'Rate') AS prevalence_rate,
+                count(*) FILTER (WHERE Measure = 'Deaths') AS deaths_rows,
+                count(*) FILTER (WHERE Measure = 'Prevalence') AS prevalence_rows
+            FROM src WHERE Measure IN ('Deaths', 'Prevalence')
+            GROUP BY Year, Location, Sex, Age, Cause
+        ),
+        final_data AS (
+            SELECT rates.*, le.region, le.flag FROM rates JOIN le USING (Year, Location)
+            WHERE deaths_rows > 0 AND prevalence_rows > 0
+        ),
+        hic_mean_cf AS (
+            SELECT {keys}, avg(deaths_rate / prevalence_rate) AS cf
+            FROM final_data WHERE flag GROUP BY {keys}
+        ),
+        adjusted AS (
+            SELECT final_data.*, cf, prevalence * cf AS adjusted_deaths
+            FROM final_data JOIN hic_mean_cf USING ({keys})
+            WHERE coalesce(least(prevalence, deaths), prevalence, deaths) > 10
+        )
+        SELECT Year, Location, Sex, Age, Cause, region,
+            deaths AS "Deaths",
+            cf AS "Counterfactual CF",
+            adjusted_deaths AS "Adjusted Deaths",
+            CASE WHEN deaths - adjusted_deaths < 0 THEN 0 ELSE deaths - adjusted_deaths END AS "Avertable Deaths"
+        FROM adjusted
+        """
+
+    @staticmethod
+    def _other_measure_query(measure, gpby):
+        keys = ', '.join(gpby)
+        name = measure.replace('"', '""')
+        return f"""
+        WITH pivoted AS (
+            SELECT Year, Location, Sex, Age, Cause,
+                max(Value) FILTER (WHERE Metric = 'Number') AS number,
+                max(Value) FILTER (WHERE Metric = 'Rate') AS rate
+            FROM src WHERE Measure = {sql_literal(measure)}
+            GROUP BY Year, Location, Sex, Age, Cause
+        ),
+        filtered AS (
+            SELECT pivoted.*, le.region, le.flag FROM pivoted JOIN le USING (Year, Location)
+            WHERE number > 10
+        ),
+        hic_mean_rate AS (
+            SELECT {keys}, avg(rate) AS hic_mean_rate FROM filtered WHERE flag GROUP BY {keys}
+        ),
+        ratios AS (
+            SELECT filtered.*, CASE WHEN hic_mean_rate / rate > 1 THEN 1 ELSE hic_mean_rate / rate END AS ratio
+            FROM filtered JOIN hic_mean_rate USING ({keys})
+        )
+        SELECT Year, Location, Sex, Age, Cause, region,
+            number AS "{name}",
+            ratio AS "AdjustRatio {name}",
+            number * ratio AS "Adjusted {name}",
+            number - number * ratio AS "Avertable {name}"
+        FROM ratios
+        """
+
+
+def check_parity(store, years, measures, benchmark, rtol=1e-9):
+    """Compare DuckDBProcessor with the pandas Processor on cached years; raises on any mismatch."""
+    expected = Processor.process_measures(store.view(years), measures, benchmark)
+    result = DuckDBProcessor(store).process_measures(years, measures, benchmark)
+    result = result.reindex(columns=expected.columns)
+    pd.testing.assert_index_equal(result.index, expected.index, exact=False)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=rtol, check_index_type=False)
+    return True
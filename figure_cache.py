@@ -0,0 +1,115 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+
+
+class FigureCache:
+    """
+    Outputs of the dashboard callbacks memoized on disk, shared by every worker process.
+
+    An entry is keyed on the callback name, a hash of its source, its arguments normalized,
+    with lists of selected values sorted and deduplicated, and a `version` of the data, so
+    neither a new results set nor an edited callback serves old figures. Entries are pickled files replaced atomically, so gunicorn workers
+    on one host read each other's outputs. A hit refreshes the file's modification time;
+    once the folder grows past `max_bytes`, the least recently used entries are removed.
+
+    `hits` and `misses` count the lookups of this process.
+    """
+
+    def __init__(self, folder, max_bytes=256 * 1024 ** 2, version=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def normalize(value):
+        if isinstance(value, (list, tuple, set)):
+            return sorted(set(value), key=str)
+        return value
+
+    @staticmethod
+    def source_hash(func):
+        """sha256 of the source of `func`, or of its bytecode when the source is not available."""
+        try:
+            source = inspect.getsource(func).encode()
+        except (OSError, TypeError):
+            source = func.__code__.co_code
+        return hashlib.sha256(source).hexdigest()
+
+    def key(self, name, args, source=None):
+        selection = [name, source, self.version] + [self.normalize(arg) for arg in args]
+        return hashlib.sha256(json.dumps(selection, default=str).encode()).hexdigest()
+
+    def entry_file(self, key):
+        return os.path.join(self.folder, f'{key}.pkl')
+
+    def get(self, key):
+        """The cached output of `key`, or None; an entry evicted by another worker is a miss."""
+        try:
+            with open(self.entry_file(key), 'rb') as f:
+                output = pickle.load(f)
+            os.utime(self.entry_file(key))
+        except (FileNotFoundError, EOFError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return output
+
+    def put(self, key, output):
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.entry_file(key))
+        self.evict()
+
+    def entries(self):
+        """(modification time, size, path) of every entry, least recently used first."""
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove the least recently used entries until the folder fits in max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries)}
+
+    def memoize(self, func):
+        """Decorate a callback so that repeated selections return the cached output."""
+        source = self.source_hash(func)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = self.key(func.__name__, args, source)
+            output = self.get(key)
+            if output is None:
+                output = func(*args)
+                self.put(key, output)
+            return output
+        return wrapper
@@ -0,0 +1,132 @@
+import json
+from rollup import RollupCube, ROLLUP_FILE, ALL
+from utils import cause_matrix
+
+# Country selection of a spec without one: the 20 countries with the most of the measure in 2018
+DEFAULT_COUNTRIES = {'top': 20, 'year': 2018}
+
+
+class FigureBatch:
+    """
+    Figures described by specs, a list of dicts or a YAML file of one, rendered as one batch.
+
+    A spec has the keys:
+        measure: A measure of the results, e.g. 'Deaths', or its 'Avertable ...' column.
+        top_n: Number of causes shown.
+        years: Years plotted side by side; [2018, 2021] by default.
+        countries: Country selection rule, either {'top': N, 'year': Y}, the N locations with the
+            most of the measure in year Y, optionally within one {'region': ...} or
+            {'sub-region': ...} of data/all.csv; or {'locations': [...]}, a fixed list.
+        label: Countries in the subplot titles; derived from the rule by default.
+        layout: Optional 'figsize' and 'legend_ncol' of the figure.
+        name: Prefix of the output file; 'top_{top_n}_causes_{column}' by default.
+
+    Specs sharing a measure and country rule share one country ranking, specs that also share
+    their years share one data slice, and each (slice, year) cause matrix is computed once for
+    every top N that plots it.
+    """
+
+    @staticmethod
+    def load_specs(specs):
+        """The normalized specs of a list of dicts, or of the path of a YAML file holding one."""
+        if isinstance(specs, str):
+            import yaml
+            with open(specs) as f:
+                specs = yaml.safe_load(f)
+        return [FigureBatch.normalize(spec) for spec in specs]
+
+    @staticmethod
+    def normalize(spec):
+        unknown = set(spec) - {'measure', 'top_n', 'years', 'countries', 'label', 'layout', 'name'}
+        if unknown:
+            raise ValueError(f'Unknown figure spec keys {sorted(unknown)}')
+        if 'measure' not in spec or 'top_n' not in spec:
+            raise ValueError(f'Figure spec {spec} needs a measure and a top_n')
+        measure = spec['measure']
+        column = measure if measure.startswith('Avertable ') else f'Avertable {measure}'
+        countries = dict(spec.get('countries') or DEFAULT_COUNTRIES)
+        if 'locations' in countries:
+            label = 'Selected Countries'
+        elif 'top' in countries and 'year' in countries:
+            area = countries.get('region') or countries.get('sub-region')
+            label = f"Top {countries['top']} Countries" + (f' of {area}' if area else '')
+        else:
+            raise ValueError(f'Country rule {countries} needs either locations, or top and year')
+        return {
+            'measure': column,
+            'top_n': int(spec['top_n']),
+            'years': [int(year) for year in spec.get('years', [2018, 2021])],
+            'countries': countries,
+            'label': spec.get('label', label),
+            'layout': dict(spec.get('layout') or {}),
+            'name': spec.get('name', f"top_{spec['top_n']}_causes_{column}"),
+        }
+
+    @staticmethod
+    def select_countries(rule, column, rankings, geography, cube_path=ROLLUP_FILE):
+        """
+        Locations of a country rule, the ranked ones in descending order of `column`.
+
+        `rankings` caches the Location totals of the rollup cube per (column, year), and
+        `geography` the region and sub-region of every ranked location, from RollupCube.geography.
+        """
+        if 'locations' in rule:
+            return list(rule['locations'])
+        key = (column, rule['year'])
+        if key not in rankings:
+            rankings[key] = (
+                RollupCube.read(cube_path, columns=[column], Level='Location', Year=rule['year'], Sex=ALL, Age=ALL, Cause=ALL)
+                .set_index('Area')[column]
+                .sort_values(ascending=False))
+        ranking = rankings[key]
+        for level in ['region', 'sub-region']:
+            if level in rule:
+                missing = [location for location in ranking.index if location not in geography]
+                if missing:
+                    geography.update(RollupCube.geography(missing).to_dict('index'))
+                ranking = ranking[[geography[location][level] == rule[level] for location in ranking.index]]
+        return ranking.head(rule['top']).index
+
+    @staticmethod
+    def jobs(specs, results, plot_folder, cube_path=ROLLUP_FILE):
+        """
+        Arguments of create_figure_for_top_n_and_measure for every spec, for render_figures.
+
+        Args:
+            specs (list): Figure specs, or the path of a YAML file of them.
+            results (pd.DataFrame): The results with Year, Location and Cause as columns.
+            plot_folder (str): Folder of the figures.
+            cube_path (str): Rollup cube used for the country rankings.
+        """
+        specs = FigureBatch.load_specs(specs)
+        # Causes keep their colour across figures, in the order of the full results
+        causes = results['Cause'].unique()
+        rankings, geography, countries_of, slices, matrices = {}, {}, {}, {}, {}
+        jobs, files = [], set()
+        for spec in specs:
+            column = spec['measure']
+            rule_key = (column, json.dumps(spec['countries'], sort_keys=True))
+            if rule_key not in countries_of:
+                countries_of[rule_key] = FigureBatch.select_countries(spec['countries'], column, rankings, geography, cube_path)
+            countries = countries_of[rule_key]
+
+            slice_key = rule_key + (tuple(spec['years']),)
+            if slice_key not in slices:
+                # Each figure only needs the plotted years of its countries
+                slices[slice_key] = results.loc[results['Year'].isin(spec['years']) & results['Location'].isin(countries),
+                                                ['Year', 'Location', 'Cause', column]]
+            plot_data = slices[slice_key]
+            # One Location × Cause aggregation per year, sliced by every top N
+            aggregates = {}
+            for year in spec['years']:
+                if slice_key + (year,) not in matrices:
+                    matrices[slice_key + (year,)] = cause_matrix(plot_data, year, countries, column)
+                aggregates[year] = matrices[slice_key + (year,)]
+
+            file = (spec['name'], spec['top_n'], column, tuple(spec['years']))
+            if file in files:
+                raise ValueError(f'Two figure specs write {file}; give one of them a name')
+            files.add(file)
+            jobs.append((plot_data, countries, spec['top_n'], column, plot_folder, spec['name'], causes, aggregates,
+                         spec['years'], spec['layout'], spec['label']))
+        return jobs
@@ -1,86 +1,177 @@
 import os
 from tqdm import tqdm
-from data_manager import DataManager
+import cube
+import duckdb_engine
+import figures
+import processor
+import resolver
+import rollup
+import uncertainty
+from data_manager import DataManager, AggregateStore
 from processor import Processor
+from cube import BurdenCube
+from uncertainty import UncertaintyProcessor
+from pipeline import Pipeline
+from rollup import RollupCube, ROLLUP_FILE
+from duckdb_engine import DuckDBProcessor, process_file_years_duckdb
+from figures import FigureBatch
 import pandas as pd
 import matplotlib.colors as mcolors
-from utils import process_file
-from utils import create_figure_for_top_n_and_measure,plot_avertable_by_condition
+from utils import process_file_years, process_file_bounds, regional_life_expectancy, benchmark_table
+from utils import create_figure_for_top_n_and_measure,plot_avertable_by_condition,render_figures,cause_matrix,figure_file
 
 def main():
     DOWNLOAD_FOLDER = './'
     DATA_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'data')
+    PLOT_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'plots')
     measures = ['DALYs (Disability-Adjusted Life Years)',
                 'YLDs (Years Lived with Disability)',
                 'Deaths',
                 'YLLs (Years of Life Lost)']
     YEARS = [2018,2019,2020,2021]
     benchmark = 'regional_benchmark'
+    WORKERS = os.cpu_count()
+    USE_CUBE = False  # Run the counterfactuals on the memory-mapped burden cube
+    ENGINE = 'pandas'  # 'duckdb' runs the ingest scans and the counterfactuals on DuckDB, on all cores
+    OUT_OF_CORE_PARTITION = 0  # Locations processed at once, streaming results to disk; 0 processes everything in memory
+    # Benchmark definitions to compare in one sensitivity sweep, e.g.
+    # [{'name': 'global_75', 'scope': 'global', 'threshold': 75},
+    #  {'name': 'regional_p90', 'scope': 'regional', 'percentile': 90}]
+    BENCHMARK_SWEEP = []
+    UNCERTAINTY_DRAWS = 0  # Monte Carlo draws from the IHME bounds; 0 skips the uncertainty intervals
+    TOP_N = [5, 10, 20]
+    TOP_COUNTRIES_YEAR = 2018
+    # Figures to render, as specs of figures.FigureBatch; the path of a YAML file of specs works too
+    FIGURE_SPECS = [{'measure': measure, 'top_n': top_n, 'years': [2018, 2021],
+                     'countries': {'top': 20, 'year': TOP_COUNTRIES_YEAR}}
+                    for measure in measures for top_n in TOP_N]
+    PLOT_WORKERS = WORKERS  # Figures rendered in parallel on the Agg backend; 1 renders them in this process
+    FORCE_STAGES = []  # Stages to re-execute even when cached, e.g. ['save_results'] after deleting the CSVs
+
+    # The counterfactuals run on one engine; out of core, the process stage writes the results files itself
+    if OUT_OF_CORE_PARTITION and (USE_CUBE or ENGINE != 'pandas'):
+        raise ValueError('OUT_OF_CORE_PARTITION runs on the pandas engine; unset USE_CUBE and set ENGINE to pandas')
+    if USE_CUBE and ENGINE != 'pandas':
+        raise ValueError(f'USE_CUBE runs the counterfactuals on the burden cube, not on {ENGINE}; set ENGINE to pandas')
 
     # Ensure data folder exists
     DataManager.ensure_data_folder()
-    
-    for YEAR in YEARS:
-        print(f'Running year {YEAR}')
-    
-        AGGREGATED_FILE = f'aggregatedGDB_{YEAR}.csv'
-    # Load or aggregate data
-        aggregated_data = DataManager.load_or_aggregate_data(AGGREGATED_FILE, process_file, YEAR)
-    
-        # Process each measure
-        all_results = None
-        for measure in tqdm(['DALYs (Disability-Adjusted Life Years)',
-            'YLDs (Years Lived with Disability)',
-            'Deaths',
-            'YLLs (Years of Life Lost)']):
-            final_data = Processor.process_measure(aggregated_data, measure, benchmark)
-            if all_results is None:
-                all_results = final_data
-            else:
-                all_results = all_results.merge(final_data, left_index=True, right_index=True, how='outer')
-    
-        # Save results
-        result_file = f'results_aggregatedGDB_{YEAR}.csv'
-        all_results.to_csv(os.path.join(DATA_FOLDER, result_file))
-    
-    #Time to plot
-    print('Plotting')
-    
-    # Constants
-    
-    DOWNLOAD_FOLDER = './'
-    DATA_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'data')
-    PLOT_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'plots')
-    if not os.path.isdir(PLOT_FOLDER):
-        os.mkdir(PLOT_FOLDER)
-    
-    RESULTS_FILES = [os.path.join(DATA_FOLDER,f'results_aggregatedGDB_{year}.csv') for year in YEARS]
-
-    # Load and combine data for all years
-    data_frames = []
-    for year, file in zip(YEARS, RESULTS_FILES):
-        if os.path.exists(file):
-            df = pd.read_csv(file)
-            df['Year'] = year
-            data_frames.append(df)
+    store = AggregateStore()
+    pipeline = Pipeline()
+
+    def ingest():
+        # Parse the source files once for every year that has no cached partitions yet
+        if ENGINE == 'duckdb':
+            # DuckDB already scans each file on all cores
+            store.build(process_file_years_duckdb, YEARS, workers=1)
         else:
-            print(f"File {file} not found!")
-
-    combined_data = pd.concat(data_frames, ignore_index=True)
-
-
-    for measure in measures:
-        m = f'Avertable {measure}'
-        top_20_countries_2018 = (
-            combined_data[combined_data['Year'] == 2018]
-            .groupby('Location')[m]
-            .sum()
-            .sort_values(ascending=False)
-            .head(20)
-            .index)
-        create_figure_for_top_n_and_measure(combined_data, top_20_countries_2018, 5, m,PLOT_FOLDER, f'top_5_causes_{m}')
-        create_figure_for_top_n_and_measure(combined_data, top_20_countries_2018, 10, m,PLOT_FOLDER, f'top_10_causes_{m}')
-        create_figure_for_top_n_and_measure(combined_data, top_20_countries_2018, 20, m,PLOT_FOLDER, f'top_20_causes_{m}')
+            store.build(process_file_years, YEARS, workers=WORKERS)
+        return {source_id: entry['sha256'] for source_id, entry in sorted(store.load_manifest().items())}
+
+    def life_expectancy(sources):
+        # Countries take the spelling of the IHME locations they resolve to
+        return regional_life_expectancy(YEARS, locations=store.codebook.categories['Location'])
+
+    def locations(sources, regional_le):
+        return DataManager.location_report(store, YEARS, regional_le)
+
+    def process(sources, regional_le):
+        # Process all years and measures in one pass, with Year as a grouping key
+        print(f'Running years {YEARS}')
+        if USE_CUBE:
+            burden_cube = BurdenCube.build(store.read(YEARS))
+            year_results = {}
+            for YEAR in tqdm(YEARS):
+                year_results[YEAR] = pd.concat([burden_cube.process_measure(measure, YEAR, regional_le.loc[YEAR], benchmark)
+                                                for measure in measures], axis=1)
+            return pd.concat(year_results, names=['Year']).sort_index()
+        if OUT_OF_CORE_PARTITION:
+            partitions = Processor.process_partitions(store.view(YEARS, regional_le), measures, benchmark, OUT_OF_CORE_PARTITION)
+            DataManager.stream_results(partitions, 'results_aggregatedGDB_{year}.csv')
+            # Only the columns the plots use are read back
+            return DataManager.load_results('results_aggregatedGDB_{year}.csv', YEARS, [f'Avertable {m}' for m in measures])
+        if ENGINE == 'duckdb':
+            return DuckDBProcessor(store).process_measures(YEARS, measures, benchmark, regional_le)
+        # Only the partitions and columns of the needed measures are loaded
+        return Processor.process_measures(store.view(YEARS, regional_le), measures, benchmark)
+
+    def save_results(all_results):
+        # Save results, one file per year
+        DataManager.save_results(all_results, 'results_aggregatedGDB_{year}.csv')
+        return sorted(all_results.index.get_level_values('Year').unique().tolist())
+
+    def sweep(sources):
+        print(f'Sweeping {len(BENCHMARK_SWEEP)} benchmark definitions')
+        sweep_results = Processor.sweep_benchmarks(store.view(YEARS), measures, BENCHMARK_SWEEP)
+        sweep_results.to_csv(os.path.join(DATA_FOLDER, 'benchmark_sweep.csv'))
+        return sweep_results
+
+    def uncertainty_intervals(sources, regional_le, all_results):
+        # The bounds live in their own store, so the default cache stays value-only
+        print(f'Drawing {UNCERTAINTY_DRAWS} samples for the uncertainty intervals')
+        bounds_store = AggregateStore(os.path.join(DATA_FOLDER, 'aggregatedGDB_bounds'))
+        bounds_store.build(process_file_bounds, YEARS, workers=WORKERS)
+        intervals = UncertaintyProcessor.simulate(bounds_store.view(YEARS, regional_le), measures, benchmark,
+                                                  draws=UNCERTAINTY_DRAWS, workers=WORKERS)
+        intervals = intervals.reindex(all_results.index)
+        intervals.to_csv(os.path.join(DATA_FOLDER, 'uncertainty_intervals.csv'))
+        return intervals
+
+    def rollups(all_results):
+        # Sums over every combination of Sex, Age, Cause and geography, next to the results
+        return len(RollupCube.build(all_results))
+
+    def plots(all_results, rollup_rows):
+        #Time to plot
+        print('Plotting')
+        if not os.path.isdir(PLOT_FOLDER):
+            os.mkdir(PLOT_FOLDER)
+
+        # Plot straight from the results in memory, with the codebook categoricals back as strings
+        combined_data = all_results.reset_index()
+        combined_data = combined_data.astype({c: object for c in combined_data.select_dtypes('category').columns})
+
+        # Specs sharing countries and years share their data slice and cause matrices
+        jobs = FigureBatch.jobs(FIGURE_SPECS, combined_data, PLOT_FOLDER)
+        # Only figures whose data slice or parameters changed are rendered again
+        files = render_figures(jobs, workers=PLOT_WORKERS, index_file=os.path.join(PLOT_FOLDER, '_index.json'), prune=True)
+        return sorted(os.path.basename(f) for f in files)
+
+    # Each stage re-executes only when its code, parameters or inputs changed, or a file it writes is missing
+    results_files = [os.path.join(DATA_FOLDER, f'results_aggregatedGDB_{year}.csv') for year in YEARS]
+    figure_files = [figure_file(PLOT_FOLDER, spec['name'], spec['top_n'], spec['measure'], spec['years'])
+                    for spec in FigureBatch.load_specs(FIGURE_SPECS)]
+    source_stats = {DataManager.source_id(source): DataManager.source_stat(source) for source in DataManager.source_files()}
+    le_files = {f: os.path.getmtime(os.path.join(DATA_FOLDER, f)) for f in ['LifeExpectancy.csv', 'all.csv']}
+    pipeline.add('ingest', ingest, params={'years': YEARS, 'sources': source_stats, 'engine': ENGINE},
+                 outputs=[store.manifest_file])
+    pipeline.add('life_expectancy', life_expectancy, inputs=['ingest'], params={'years': YEARS, 'files': le_files},
+                 code=[regional_life_expectancy, benchmark_table, resolver])
+    pipeline.add('locations', locations, inputs=['ingest', 'life_expectancy'], code=[resolver],
+                 outputs=[os.path.join(DATA_FOLDER, 'unmatched_locations.csv')])
+    pipeline.add('process', process, inputs=['ingest', 'life_expectancy'],
+                 params={'years': YEARS, 'measures': measures, 'benchmark': benchmark, 'use_cube': USE_CUBE, 'engine': ENGINE,
+                         'out_of_core': OUT_OF_CORE_PARTITION},
+                 code=[processor, cube, duckdb_engine], outputs=results_files if OUT_OF_CORE_PARTITION else [])
+    if not OUT_OF_CORE_PARTITION:
+        # Out of core, the process stage already streamed the results files
+        pipeline.add('save_results', save_results, inputs=['process'], outputs=results_files)
+    if BENCHMARK_SWEEP:
+        pipeline.add('sweep', sweep, inputs=['ingest'],
+                     params={'years': YEARS, 'measures': measures, 'benchmarks': BENCHMARK_SWEEP, 'files': le_files},
+                     code=[processor], outputs=[os.path.join(DATA_FOLDER, 'benchmark_sweep.csv')])
+    if UNCERTAINTY_DRAWS:
+        pipeline.add('uncertainty', uncertainty_intervals, inputs=['ingest', 'life_expectancy', 'process'],
+                     params={'years': YEARS, 'measures': measures, 'benchmark': benchmark,
+                             'draws': UNCERTAINTY_DRAWS, 'sources': source_stats},
+                     code=[processor, uncertainty], outputs=[os.path.join(DATA_FOLDER, 'uncertainty_intervals.csv')])
+    pipeline.add('rollups', rollups, inputs=['process'], code=[rollup, resolver], params={'files': le_files},
+                 outputs=[ROLLUP_FILE])
+    pipeline.add('plots', plots, inputs=['process', 'rollups'],
+                 params={'specs': FigureBatch.load_specs(FIGURE_SPECS)},
+                 code=[create_figure_for_top_n_and_measure, plot_avertable_by_condition, cause_matrix, figures],
+                 outputs=figure_files)
+    pipeline.run(force=FORCE_STAGES)
 
 
 if __name__ == '__main__':
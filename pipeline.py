@@ -0,0 +1,152 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+from utils import DATA_FOLDER
+
+STAGE_CACHE_FOLDER = os.path.join(DATA_FOLDER, 'stage_cache')
+
+
+class Stage:
+    """
+    A named step of the pipeline.
+
+    `func` is called with the outputs of the `inputs` stages as positional arguments, in order.
+    `params` is anything JSON serializable the output depends on, and `code` lists the modules or
+    functions, besides `func` itself, whose source is part of the stage's code version.
+    `outputs` lists the files or folders the stage writes besides its return value; the stage
+    runs again when one of them is missing, even with a cached return value.
+    """
+
+    def __init__(self, name, func, inputs=(), params=None, code=(), version=None, outputs=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = params
+        self.code = list(code)
+        self.version = version
+        self.outputs = list(outputs)
+
+    def missing_outputs(self):
+        return [path for path in self.outputs if not os.path.exists(path)]
+
+    def code_version(self):
+        sources = [inspect.getsource(obj) for obj in [self.func] + self.code]
+        return hashlib.sha256('\n'.join(sources + [str(self.version)]).encode()).hexdigest()
+
+    def fingerprint(self, input_digests):
+        """Key of the stage's output: its code version, parameters and the digests of its inputs."""
+        key = {
+            'name': self.name,
+            'code': self.code_version(),
+            'params': self.params,
+            'inputs': input_digests,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Pipeline:
+    """
+    Stages run in dependency order with their outputs memoized on disk.
+
+    Each output is pickled under its stage's fingerprint, together with a digest of the pickled
+    bytes. Downstream fingerprints use those digests, so a stage re-executes only when its code,
+    its parameters or the content of an input changed, or a file it declares is missing; an
+    upstream stage that re-ran with the same output does not invalidate anything below it. Once the cache grows past `max_bytes`,
+    the least recently used entries are evicted, keeping those of the current run.
+    """
+
+    def __init__(self, cache_folder=STAGE_CACHE_FOLDER, max_bytes=2 * 1024 ** 3):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.stages = {}
+        self.index_file = os.path.join(cache_folder, '_index.json')
+
+    def add(self, name, func, inputs=(), params=None, code=(), version=None, outputs=()):
+        for dependency in inputs:
+            if dependency not in self.stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dependency}')
+        self.stages[name] = Stage(name, func, inputs, params, code, version, outputs)
+        return self
+
+    def load_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file) as f:
+            return json.load(f)
+
+    def save_index(self, index):
+        with open(self.index_file, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+
+    def entry_file(self, key):
+        return os.path.join(self.cache_folder, f'{key}.pkl')
+
+    def run(self, targets=None, force=()):
+        """
+        Run the given stages, and the stages they depend on, reusing cached outputs.
+
+        Args:
+            targets (list): Stage names to produce; all stages by default.
+            force (list): Stage names to re-execute even when cached.
+
+        Returns:
+            dict: The output of every stage that was needed, by name.
+        """
+        os.makedirs(self.cache_folder, exist_ok=True)
+        index = self.load_index()
+        outputs, digests, used = {}, {}, set()
+        for stage in self.order(targets):
+            key = stage.fingerprint([digests[name] for name in stage.inputs])
+            entry = index.get(key)
+            missing = stage.missing_outputs()
+            if entry is not None and stage.name not in force and os.path.exists(self.entry_file(key)) and not missing:
+                print(f'Stage {stage.name}: cached')
+                with open(self.entry_file(key), 'rb') as f:
+                    outputs[stage.name] = pickle.load(f)
+            else:
+                print(f'Stage {stage.name}: running' + (f' ({len(missing)} missing outputs)' if entry is not None and missing else ''))
+                outputs[stage.name] = stage.func(*[outputs[name] for name in stage.inputs])
+                payload = pickle.dumps(outputs[stage.name], protocol=pickle.HIGHEST_PROTOCOL)
+                with open(self.entry_file(key), 'wb') as f:
+                    f.write(payload)
+                entry = {'stage': stage.name, 'digest': hashlib.sha256(payload).hexdigest(), 'size': len(payload)}
+            entry['used'] = time.time()
+            index[key] = entry
+            digests[stage.name] = entry['digest']
+            used.add(key)
+            self.save_index(index)
+        self.evict(index, used)
+        return outputs
+
+    def order(self, targets=None):
+        """The stages needed for `targets`, each after its inputs."""
+        ordered, seen = [], set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            for dependency in self.stages[name].inputs:
+                visit(dependency)
+            ordered.append(self.stages[name])
+
+        for name in targets or self.stages:
+            visit(name)
+        return ordered
+
+    def evict(self, index, keep=()):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        total = sum(entry['size'] for entry in index.values())
+        for key, entry in sorted(index.items(), key=lambda item: item[1]['used']):
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            if os.path.exists(self.entry_file(key)):
+                os.remove(self.entry_file(key))
+            total -= entry['size']
+            del index[key]
+        self.save_index(index)
@@ -1,26 +1,315 @@
+import os
+import tempfile
 import numpy as np
 import pandas as pd
+from utils import benchmark_table
 
 
 class Processor:
+    COLUMNS = ['Measure', 'Location', 'Sex', 'Age', 'Cause', 'Metric', 'Value']
+    ROW_KEYS = ['Location', 'Sex', 'Age', 'Cause']
+    KEYS = ROW_KEYS + ['region']
+
+    @staticmethod
+    def year_keys(data):
+        """['Year'] for a multi-year frame, so every year is benchmarked within itself."""
+        return ['Year'] if 'Year' in data.columns else []
+
+    @staticmethod
+    def source_measures(measure):
+        """IHME measures needed to compute the given measure."""
+        return ['Deaths', 'Prevalence'] if measure == 'Deaths' else [measure]
+
     @staticmethod
     def process_measure(data, measure, benchmark):
         """
         Process data for a specific measure.
         
         Args:
-            data (pd.DataFrame): The aggregated data.
+            data (pd.DataFrame or AggregatedView): The aggregated data, or a view of the Parquet
+                store from which only the partitions and columns of this measure are loaded.
             measure (str): The measure to process (e.g., 'Deaths', 'DALYs').
             hic_countries (list): List of high-income countries for benchmarks.
         
         Returns:
             pd.DataFrame: Processed data for the specified measure.
         """
+        if not isinstance(data, pd.DataFrame):
+            return Processor.process_measures(data, [measure], benchmark)
         if measure == 'Deaths':
             return Processor._process_deaths(data, benchmark)
         else:
             return Processor._process_other_measure(data, measure, benchmark)
 
+    @staticmethod
+    def process_measures(data, measures, benchmark):
+        """
+        Process several measures in one pass.
+
+        The rows of every needed measure are pivoted once into a wide frame with a column
+        per (Measure, Metric), each measure's counterfactual is computed from its own columns,
+        and the outputs are assembled by index alignment instead of chained outer merges.
+        A row counts as reported for a measure when the data has a row of it, even with NaN values.
+
+        A frame with a Year column is processed for all its years at once: Year joins the
+        index and the benchmark group keys, so each year's benchmarks only use that year.
+
+        Args:
+            data (pd.DataFrame or AggregatedView): The aggregated data, or a view of cached years
+                of the Parquet store, loading only the partitions and columns of `measures`.
+            measures (list): The measures to process.
+            benchmark (str): 'global_benchmark' or 'regional_benchmark'.
+
+        Returns:
+            pd.DataFrame: The columns of every measure, in the order of `measures`.
+        """
+        regional_le = Processor._benchmark_flags(data)
+        return Processor._counterfactuals(Processor._load_measures(data, measures), measures, benchmark, regional_le=regional_le)
+
+    @staticmethod
+    def process_partitions(data, measures, benchmark, partition_size):
+        """
+        Process several measures out of core, a bounded number of locations at a time.
+
+        The view is first split into one folder per `partition_size` locations, in a temporary
+        folder next to the store, reading each part file of the store once. A first pass loads the
+        benchmark locations of each partition and keeps the grouped sums and counts their
+        benchmark means are made of. A second pass loads each partition in turn and applies the
+        per-row formulas against those means, so peak memory follows the partition size, or the
+        largest part file, rather than the number of locations.
+
+        Args:
+            data (AggregatedView): The cached years.
+            measures (list): The measures to process.
+            benchmark (str): 'global_benchmark' or 'regional_benchmark'.
+            partition_size (int): Number of locations loaded at once.
+
+        Yields:
+            pd.DataFrame: The output of process_measures for each partition, in Location order.
+        """
+        regional_le = Processor._benchmark_flags(data)
+        locations = regional_le.index.get_level_values(-1)
+        known = set(data.store.codebook.categories['Location'])
+        all_locations = sorted(set(locations) & known)
+        bench_locations = sorted(set(locations[regional_le[benchmark].to_numpy(dtype=bool)]) & known)
+        partitions = [all_locations[start:start + partition_size] for start in range(0, len(all_locations), partition_size)]
+        needed = list(dict.fromkeys(m for measure in measures for m in Processor.source_measures(measure)))
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(data.store.path))) as path:
+            partitions = data.split_locations(partitions, needed, path)
+            means = Processor._benchmark_means(partitions, measures, benchmark, bench_locations, regional_le)
+            for partition in partitions:
+                partition = Processor._load_measures(partition, measures)
+                if len(partition):
+                    yield Processor._counterfactuals(partition, measures, benchmark, means, regional_le)
+
+    @staticmethod
+    def _counterfactuals(data, measures, benchmark, means=None, regional_le=None):
+        """
+        The counterfactuals of process_measures, against precomputed benchmark means if given.
+
+        The region and benchmark flags come from the Year × Location table `regional_le` when
+        given, rather than from the columns repeated on every row of `data`.
+        """
+        means = means or {}
+        if regional_le is None:
+            regional_le = Processor._benchmark_flags(data)
+        wide = Processor._wide(data, regional_le)
+
+        outputs = []
+        for measure in measures:
+            if measure == 'Deaths':
+                final_data = Processor._measure_inputs(wide, measure)
+                outputs.append(Processor._deaths_counterfactual(final_data, benchmark, hic_mean_cf=means.get(measure)))
+            else:
+                pivoted_data = Processor._measure_inputs(wide, measure)
+                outputs.append(Processor._other_measure_counterfactual(pivoted_data, measure, None, benchmark,
+                                                                       hic_mean_rate=means.get(measure)))
+        return pd.concat(outputs, axis=1).sort_index()
+
+    @staticmethod
+    def _benchmark_means(partitions, measures, benchmark, bench_locations, regional_le):
+        """
+        Benchmark means of every measure, from the benchmark locations of each partition in turn.
+
+        Each partition contributes grouped sums and counts of the non-NaN values, so the means are
+        the same as a grouped mean over all benchmark rows at once; a group whose rows are all NaN
+        keeps a NaN mean.
+        """
+        partials = {measure: [] for measure in measures}
+        for partition in partitions:
+            partition = Processor._load_measures(partition, measures, locations=bench_locations)
+            if not len(partition):
+                continue
+            wide = Processor._wide(partition, regional_le)
+            for measure in measures:
+                rows = Processor._measure_inputs(wide, measure)
+                if measure == 'Deaths':
+                    rows = rows[rows[benchmark]]
+                    values = rows['Deaths Rate'] / rows['Prevalence Rate']
+                else:
+                    rows = rows[(rows[measure] > 10) & rows[benchmark]]
+                    values = rows['Rate']
+                grouped = values.groupby(level=Processor._benchmark_groups(rows, benchmark), observed=True)
+                partials[measure].append(pd.DataFrame({'sum': grouped.sum(), 'count': grouped.count()}))
+
+        means = {}
+        for measure, frames in partials.items():
+            name = 'Counterfactual CF' if measure == 'Deaths' else 'HIC_mean_rate'
+            if not frames:
+                means[measure] = pd.Series(dtype='float64', name=name)
+                continue
+            totals = pd.concat(frames)
+            totals = totals.groupby(level=list(totals.index.names), observed=True).sum()
+            means[measure] = (totals['sum'] / totals['count']).rename(name)
+        return means
+
+    @staticmethod
+    def sweep_benchmarks(data, measures, benchmarks):
+        """
+        Process several measures under many benchmark definitions in one pass.
+
+        The data is pivoted once. Its rows are then repeated once per scenario, carrying that
+        scenario's benchmark flags and group (the region for regional scopes, a single group
+        otherwise), so every scenario's benchmark means come out of one grouped reduction
+        keyed by Scenario, and the counterfactual formulas run once over all scenarios.
+
+        Args:
+            data (pd.DataFrame or AggregatedView): The aggregated data, with a Year column.
+            measures (list): The measures to process.
+            benchmarks (list): Benchmark definitions, as taken by utils.benchmark_table.
+
+        Returns:
+            pd.DataFrame: The columns of process_measures, indexed by Scenario and then the usual keys.
+        """
+        # The scenarios bring their own flags, only the region is attached
+        wide = Processor._wide(Processor._load_measures(data, measures), Processor._benchmark_flags(data)[['region']])
+        # Countries take the spelling of the locations they resolve to, so that relabelled ones keep their flags
+        table = benchmark_table(sorted(wide.index.get_level_values('Year').unique()), benchmarks,
+                                locations=wide.index.get_level_values('Location').unique().astype(object))
+        gpby = ['Scenario', 'Year', 'Sex', 'Age', 'Cause', 'Group']
+
+        outputs = []
+        for measure in measures:
+            scenario_data = Processor._expand_scenarios(Processor._measure_inputs(wide, measure), table, benchmarks)
+            if measure == 'Deaths':
+                output = Processor._deaths_counterfactual(scenario_data, 'in_benchmark', gpby)
+            else:
+                output = Processor._other_measure_counterfactual(scenario_data, measure, None, 'in_benchmark', gpby)
+            outputs.append(output.droplevel('Group'))
+        return pd.concat(outputs, axis=1).sort_index()
+
+    @staticmethod
+    def _expand_scenarios(inputs, table, benchmarks):
+        """
+        Repeat the rows of `inputs` once per benchmark definition, with its flags and benchmark group.
+
+        The repeated index is assembled from the codes of the original one, so no label is hashed
+        again per scenario.
+        """
+        positions = table.index.get_indexer(pd.MultiIndex.from_arrays([
+            inputs.index.get_level_values('Year'),
+            inputs.index.get_level_values('Location').astype(object),
+        ]))
+        regions = pd.Categorical(inputs.index.get_level_values('region').astype(object))
+        everywhere = len(regions.categories)
+        flags, groups = [], []
+        for benchmark in benchmarks:
+            flags.append(np.where(positions >= 0, table[benchmark['name']].to_numpy(dtype=bool)[positions], False))
+            groups.append(regions.codes if benchmark['scope'] == 'regional' else np.full(len(inputs), everywhere))
+
+        n, index = len(benchmarks), inputs.index
+        scenario_index = pd.MultiIndex(
+            levels=[[benchmark['name'] for benchmark in benchmarks]] + list(index.levels) + [list(regions.categories) + ['All']],
+            codes=[np.repeat(np.arange(n), len(inputs))] + [np.tile(codes, n) for codes in index.codes] + [np.concatenate(groups)],
+            names=['Scenario'] + list(index.names) + ['Group'],
+        )
+        scenario_data = pd.DataFrame(np.tile(inputs.to_numpy(), (n, 1)), index=scenario_index, columns=inputs.columns)
+        scenario_data['in_benchmark'] = np.concatenate(flags)
+        return scenario_data
+
+    @staticmethod
+    def _load_measures(data, measures, columns=None, locations=None):
+        """Rows of the IHME measures needed for `measures`, of the given locations only if any."""
+        needed = list(dict.fromkeys(m for measure in measures for m in Processor.source_measures(measure)))
+        if not isinstance(data, pd.DataFrame):
+            return data.load(needed, columns or Processor.COLUMNS, locations)
+        if locations is not None:
+            data = data[data['Location'].isin(locations)]
+        return data[data['Measure'].isin(needed)]
+
+    @staticmethod
+    def _wide(data, regional_le):
+        """
+        One column per (Measure, Metric), one row per Year and key, and a (Measure, 'Reported')
+        column telling whether the data has a row of that measure, whatever its values.
+
+        The region and the flag columns of `regional_le` are attached once, after the pivot, to
+        the rows of the locations it has; each flag becomes a ('Benchmark', flag) column.
+        """
+        # Cells without a row are filled with -inf, which no value takes, so they can be told from NaN values
+        wide = (
+            data.set_index(Processor.year_keys(data) + Processor.ROW_KEYS + ['Measure', 'Metric'])['Value']
+            .unstack(['Measure', 'Metric'], fill_value=-np.inf)
+        )
+        absent = wide.to_numpy() == -np.inf
+        measures = wide.columns.get_level_values('Measure')
+        wide = wide.mask(absent)
+        for measure in measures.unique():
+            wide[(measure, 'Reported')] = ~absent[:, measures == measure].all(axis=1)
+        wide, flags = Processor._attach_flags(wide, regional_le)
+        for flag in flags.columns:
+            wide[('Benchmark', flag)] = flags[flag].to_numpy()
+        return wide
+
+    @staticmethod
+    def _attach_flags(wide, regional_le):
+        """
+        The rows of `wide` whose (Year and) Location is in `regional_le`, like an inner merge,
+        with the region appended to their index, and the other columns of `regional_le` for
+        those rows.
+        """
+        keys = list(regional_le.index.names)
+        rows = wide.index.to_frame(index=False)[keys].join(regional_le, on=keys, how='inner')
+        wide = wide.iloc[rows.index.to_numpy()]
+        wide = wide.set_index(pd.CategoricalIndex(rows['region'], name='region'), append=True)
+        return wide, rows.drop(columns=keys + ['region']).set_axis(wide.index)
+
+    @staticmethod
+    def _measure_inputs(wide, measure):
+        """
+        The columns a measure's counterfactual starts from.
+
+        Deaths gets the Deaths and Prevalence numbers and rates of the rows reporting both,
+        like the inner merge of their pivots; other measures get their number and Rate. Both
+        keep the benchmark flags of `wide`.
+        """
+        flags = [column for column in wide.columns if column[0] == 'Benchmark']
+        if measure == 'Deaths':
+            reported = (wide[('Deaths', 'Reported')] & wide[('Prevalence', 'Reported')]).to_numpy()
+            final_data = wide.loc[reported, [('Deaths', 'Number'), ('Deaths', 'Rate'), ('Prevalence', 'Number'), ('Prevalence', 'Rate')] + flags]
+            final_data.columns = ['Deaths', 'Deaths Rate', 'Prevalence', 'Prevalence Rate'] + [flag for _, flag in flags]
+            return final_data
+        pivoted_data = wide[[(measure, 'Number'), (measure, 'Rate')] + flags]
+        pivoted_data.columns = [measure, "Rate"] + [flag for _, flag in flags]
+        return pivoted_data
+
+    @staticmethod
+    def _benchmark_flags(data):
+        """
+        Region and benchmark flags per Year and Location: the columns of a frame, or the table of
+        utils.regional_life_expectancy of a view.
+        """
+        if isinstance(data, pd.DataFrame):
+            keys = Processor.year_keys(data) + ['Location']
+            return data[keys + ['region', 'regional_benchmark', 'global_benchmark']].drop_duplicates().set_index(keys)
+        return data.regional_le()[['region', 'regional_benchmark', 'global_benchmark']]
+
+    @staticmethod
+    def _regional_le(data):
+        keys = Processor.year_keys(data) + ['Location']
+        regional_le = data[['regional_benchmark','global_benchmark'] + keys].drop_duplicates()
+        return regional_le.set_index(keys)
+
     @staticmethod
     def _process_deaths(data, benchmark = 'global_benchmark'):
         """
@@ -33,33 +322,26 @@ class Processor:
         Returns:
             pd.DataFrame: Processed data for 'Deaths'.
         """
-        final_data = None
-        regional_le = data[['regional_benchmark','global_benchmark','Location']].drop_duplicates()
-        regional_le = regional_le.set_index('Location')
-        for sub_measure in ['Deaths', 'Prevalence']:
-            measure_data = data[data['Measure'] == sub_measure].set_index(['Location', 'Sex', 'Age', 'Cause','region'])
-            measure_data = measure_data.pivot(columns='Metric', values='Value')
-            measure_data.columns = [f'{sub_measure}', f'{sub_measure} Rate']
-            if final_data is None:
-                final_data = measure_data
-            else:
-                final_data = final_data.merge(measure_data, left_index=True, right_index=True, how='inner')
-        final_data = final_data.merge(regional_le,
-                                      left_on=['Location'],
-                                      right_index=True)
+        return Processor._deaths_counterfactual(Processor._deaths_rates(data), benchmark)
 
-        # Calculate HIC mean counterfactual CF
-        gpby = ['Sex', 'Age', 'Cause']
-        ret_cols = ['Deaths', 'Counterfactual CF', 'Adjusted Deaths', 'Avertable Deaths']
+    @staticmethod
+    def _benchmark_groups(data, benchmark):
+        """Group keys of the benchmark means: Sex, Age and Cause, within Year and region when present."""
+        gpby = [key for key in ['Year'] if key in data.index.names] + ['Sex', 'Age', 'Cause']
         if benchmark == 'regional_benchmark':
             gpby += ['region']
+        return gpby
+
+    @staticmethod
+    def _deaths_counterfactual(final_data, benchmark, gpby=None, hic_mean_cf=None):
+        """Counterfactual deaths from the output of _deaths_rates, with precomputed benchmark means if given."""
+        # Calculate HIC mean counterfactual CF
+        if gpby is None:
+            gpby = Processor._benchmark_groups(final_data, benchmark)
+        ret_cols = ['Deaths', 'Counterfactual CF', 'Adjusted Deaths', 'Avertable Deaths']
         
-        hic_mean_cf = (
-            final_data.loc[final_data[benchmark]]
-            .groupby(gpby)
-            .apply(lambda x: np.nanmean(x['Deaths Rate'] / x['Prevalence Rate']))
-            .rename("Counterfactual CF")
-        )
+        if hic_mean_cf is None:
+            hic_mean_cf = Processor._counterfactual_cf(final_data, benchmark, gpby)
 
         final_data = final_data.join(hic_mean_cf, on=gpby, how='inner')
         final_data = final_data[final_data[['Prevalence', 'Deaths']].min(axis=1) > 10]
@@ -71,6 +353,39 @@ class Processor:
 
         return final_data[ret_cols]
 
+    @staticmethod
+    def _deaths_rates(data):
+        """Deaths and Prevalence numbers and rates side by side, with the benchmark flags."""
+        final_data = None
+        regional_le = Processor._regional_le(data)
+        for sub_measure in ['Deaths', 'Prevalence']:
+            measure_data = data[data['Measure'] == sub_measure].set_index(Processor.year_keys(data) + Processor.KEYS)
+            measure_data = measure_data.pivot(columns='Metric', values='Value')
+            measure_data.columns = [f'{sub_measure}', f'{sub_measure} Rate']
+            if final_data is None:
+                final_data = measure_data
+            else:
+                final_data = final_data.merge(measure_data, left_index=True, right_index=True, how='inner')
+        return final_data.merge(regional_le,
+                                left_on=list(regional_le.index.names),
+                                right_index=True)
+
+    @staticmethod
+    def _counterfactual_cf(final_data, benchmark, gpby):
+        """
+        Mean case-fatality ratio of the benchmark rows per group.
+
+        The ratio is computed once as a column and reduced with a grouped mean, which skips NaN
+        exactly like np.nanmean and returns NaN for groups without any valid ratio.
+        """
+        benchmark_data = final_data.loc[final_data[benchmark]]
+        return (
+            (benchmark_data['Deaths Rate'] / benchmark_data['Prevalence Rate'])
+            .groupby(level=gpby, observed=True)
+            .mean()
+            .rename("Counterfactual CF")
+        )
+
     @staticmethod
     def _process_other_measure(data, measure, benchmark):
         """
@@ -84,33 +399,42 @@ class Processor:
         Returns:
             pd.DataFrame: Processed data for the specified measure.
         """
-        regional_le = data[['regional_benchmark','global_benchmark','Location']].drop_duplicates()
-        regional_le = regional_le.set_index('Location')
+        regional_le = Processor._regional_le(data)
         
-        measure_data = data[data['Measure'] == measure].set_index(['Location', 'Sex', 'Age', 'Cause','region'])
+        measure_data = data[data['Measure'] == measure].set_index(Processor.year_keys(data) + Processor.KEYS)
         
         # Pivot data to get metrics as columns
         pivoted_data = measure_data.pivot(columns='Metric', values='Value')
         pivoted_data.columns = [measure, "Rate"]
-        
+        return Processor._other_measure_counterfactual(pivoted_data, measure, regional_le, benchmark)
+
+    @staticmethod
+    def _other_measure_counterfactual(pivoted_data, measure, regional_le, benchmark, gpby=None, hic_mean_rate=None):
+        """
+        Counterfactual values of a measure from its Number and Rate columns.
+
+        The benchmark flags come from `regional_le`, or are already columns of `pivoted_data`
+        when it is None. The benchmark means are computed from `pivoted_data` unless given.
+        """
         # Filter out rows with very low values
         filtered_data = pivoted_data[pivoted_data[measure] > 10]
         
-        filtered_data = filtered_data.merge(regional_le,left_on=['Location'], right_index=True)
+        if regional_le is not None:
+            filtered_data = filtered_data.merge(regional_le,left_on=list(regional_le.index.names), right_index=True)
 
         # Calculate HIC mean counterfactual CF
-        gpby = ['Sex', 'Age', 'Cause']
+        if gpby is None:
+            gpby = Processor._benchmark_groups(filtered_data, benchmark)
         ret_cols = [measure, f'AdjustRatio {measure}', f'Adjusted {measure}', f'Avertable {measure}']
-        if benchmark == 'regional_benchmark':
-            gpby += ['region']
         
         # Calculate HIC mean rate
-        hic_mean_rate = (
-            filtered_data.loc[filtered_data[benchmark]]
-            .groupby(gpby)['Rate']
-            .mean()
-            .rename('HIC_mean_rate')
-        )
+        if hic_mean_rate is None:
+            hic_mean_rate = (
+                filtered_data.loc[filtered_data[benchmark]]
+                .groupby(gpby, observed=True)['Rate']
+                .mean()
+                .rename('HIC_mean_rate')
+            )
         filtered_data = filtered_data.join(hic_mean_rate, on=gpby,how='inner')
         # Calculate adjustment ratio
         filtered_data[f'AdjustRatio {measure}'] = (filtered_data['HIC_mean_rate'] / filtered_data['Rate']).clip(upper=1)
@@ -0,0 +1,71 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+
+class QueryStore:
+    """
+    The dashboard data sorted by (Cause, Year, Sex, Age), with the row range of every key.
+
+    A selection of one cause and lists of years, sexes and ages is a handful of lookups in the
+    range table and a slice of each range, instead of masks over every row, so its cost follows
+    the number of selected rows rather than the size of the data. Neighbouring ranges are
+    merged, so leaving the trailing keys unselected reads one contiguous block.
+    """
+    KEYS = ['Cause', 'Year', 'Sex', 'Age']
+
+    def __init__(self, data):
+        # Labels in order of first appearance, for the dropdowns
+        self.labels = {key: list(data[key].unique()) for key in self.KEYS}
+        codes = np.column_stack([self._codes(data[key]) for key in self.KEYS])
+        order = np.lexsort(codes.T[::-1])
+        self.data = data.iloc[order].reset_index(drop=True)
+        codes = codes[order]
+
+        change = np.flatnonzero((np.diff(codes, axis=0) != 0).any(axis=1)) + 1
+        starts = np.r_[0, change] if len(codes) else np.array([], dtype=int)
+        stops = np.r_[change, len(codes)] if len(codes) else np.array([], dtype=int)
+        keys = self.data.loc[starts, self.KEYS].itertuples(index=False, name=None)
+        self.ranges = {key: (start, stop) for key, start, stop in zip(keys, starts.tolist(), stops.tolist())}
+        # Values of each key in sort order, to expand a key left unselected
+        self.values = {key: sorted(self.labels[key], key=self._sort_key(data[key])) for key in self.KEYS}
+
+    @staticmethod
+    def _codes(column):
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            return column.cat.codes.to_numpy()
+        return pd.factorize(column, sort=True)[0]
+
+    @staticmethod
+    def _sort_key(column):
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            position = {label: i for i, label in enumerate(column.cat.categories)}
+            return position.get
+        return lambda label: label
+
+    def select(self, cause, years=None, sexes=None, ages=None, columns=None):
+        """
+        Rows of one cause, for the given years, sexes and ages; None selects all of a key.
+
+        Returns:
+            pd.DataFrame: The selected rows, in (Cause, Year, Sex, Age) order, with `columns` only
+                when given.
+        """
+        # Known values in sort order, so that the ranges come out ascending
+        selection = [[cause]]
+        for key, values in zip(self.KEYS[1:], [years, sexes, ages]):
+            selection.append(self.values[key] if values is None else [v for v in self.values[key] if v in set(values)])
+        ranges = []
+        for key in itertools.product(*selection):
+            if key in self.ranges:
+                start, stop = self.ranges[key]
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1][1] = stop
+                else:
+                    ranges.append([start, stop])
+        data = self.data if columns is None else self.data[columns]
+        if not ranges:
+            return data.iloc[:0]
+        if len(ranges) == 1:
+            return data.iloc[ranges[0][0]:ranges[0][1]]
+        return data.iloc[np.concatenate([np.arange(start, stop) for start, stop in ranges])]
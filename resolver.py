@@ -0,0 +1,167 @@
+import unicodedata
+import pandas as pd
+
+# World Bank spellings of LifeExpectancy.csv that differ from the ISO names of all.csv
+WORLD_BANK_ALPHA_3 = {
+    'Bahamas, The': 'BHS',
+    'Bolivia': 'BOL',
+    'Congo, Dem. Rep.': 'COD',
+    'Congo, Rep.': 'COG',
+    "Cote d'Ivoire": 'CIV',
+    'Egypt, Arab Rep.': 'EGY',
+    'Gambia, The': 'GMB',
+    'Iran, Islamic Rep.': 'IRN',
+    "Korea, Dem. People's Rep.": 'PRK',
+    'Korea, Rep.': 'KOR',
+    'Kyrgyz Republic': 'KGZ',
+    'Lao PDR': 'LAO',
+    'Micronesia, Fed. Sts.': 'FSM',
+    'Moldova': 'MDA',
+    'Netherlands': 'NLD',
+    'Slovak Republic': 'SVK',
+    'St. Kitts and Nevis': 'KNA',
+    'St. Lucia': 'LCA',
+    'St. Vincent and the Grenadines': 'VCT',
+    'Tanzania': 'TZA',
+    'Turkiye': 'TUR',
+    'United Kingdom': 'GBR',
+    'United States': 'USA',
+    'Venezuela, RB': 'VEN',
+    'Yemen, Rep.': 'YEM',
+}
+
+# IHME location names that differ from the ISO names of all.csv
+IHME_NAMES = {
+    'ASM': 'American Samoa',
+    'BHS': 'Bahamas',
+    'BMU': 'Bermuda',
+    'BOL': 'Bolivia (Plurinational State of)',
+    'COG': 'Congo',
+    'COK': 'Cook Islands',
+    'CIV': "Côte d'Ivoire",
+    'PRK': "Democratic People's Republic of Korea",
+    'COD': 'Democratic Republic of the Congo',
+    'EGY': 'Egypt',
+    'GMB': 'Gambia',
+    'GRL': 'Greenland',
+    'GUM': 'Guam',
+    'IRN': 'Iran (Islamic Republic of)',
+    'KGZ': 'Kyrgyzstan',
+    'LAO': "Lao People's Democratic Republic",
+    'FSM': 'Micronesia (Federated States of)',
+    'NLD': 'Netherlands',
+    'NIU': 'Niue',
+    'MNP': 'Northern Mariana Islands',
+    'PSE': 'Palestine',
+    'PRI': 'Puerto Rico',
+    'KOR': 'Republic of Korea',
+    'MDA': 'Republic of Moldova',
+    'KNA': 'Saint Kitts and Nevis',
+    'LCA': 'Saint Lucia',
+    'VCT': 'Saint Vincent and the Grenadines',
+    'SVK': 'Slovakia',
+    'TWN': 'Taiwan (Province of China)',
+    'TKL': 'Tokelau',
+    'TUR': 'Türkiye',
+    'GBR': 'United Kingdom',
+    'TZA': 'United Republic of Tanzania',
+    'VIR': 'United States Virgin Islands',
+    'USA': 'United States of America',
+    'VEN': 'Venezuela (Bolivarian Republic of)',
+    'YEM': 'Yemen',
+}
+
+
+class LocationResolver:
+    """
+    One alias index from every known spelling of a country to its alpha-3 code.
+
+    The aliases are the name, alpha-2 and alpha-3 of all.csv, both sides of the `remap` table,
+    the IHME names and the World Bank spellings, compared without case, accents or repeated
+    spaces. Names are resolved once per distinct value, never per row.
+
+    A country's location name is its all.csv name passed through `remap`, as the results have
+    always used.
+    """
+
+    def __init__(self, countries, remap=None):
+        remap = remap or {}
+        self.countries = countries
+        self.index = {}
+        aliases = [
+            (countries.index, countries.index),
+            (countries['alpha-2'], countries.index),
+            (countries['name'], countries.index),
+        ]
+        by_name = dict(zip(countries['name'], countries.index))
+        aliases.append((list(remap.values()), [by_name.get(name) for name in remap]))
+        aliases.append((list(IHME_NAMES.values()), list(IHME_NAMES)))
+        aliases.append((list(WORLD_BANK_ALPHA_3), list(WORLD_BANK_ALPHA_3.values())))
+        # Earlier aliases win, so an ISO code or name is never shadowed by a looser spelling
+        for names, codes in aliases:
+            for name, code in zip(names, codes):
+                if code is not None and isinstance(name, str):
+                    self.index.setdefault(self.normalize(name), code)
+        self.names = {code: remap.get(name, name) for code, name in zip(countries.index, countries['name'])}
+
+    @classmethod
+    def load(cls, path, remap=None):
+        """Read all.csv; 'NA' is Namibia's alpha-2 code, so only empty fields are missing."""
+        countries = pd.read_csv(path, keep_default_na=False, na_values=[''],
+                                usecols=['name', 'alpha-2', 'alpha-3', 'region', 'sub-region'])
+        countries = countries.dropna(subset=['alpha-3']).drop_duplicates('alpha-3')
+        return cls(countries.set_index('alpha-3'), remap)
+
+    @staticmethod
+    def normalize(name):
+        name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode()
+        return ' '.join(name.replace('’', "'").casefold().split())
+
+    def alpha_3(self, names):
+        """Alpha-3 code of each name, None when unmatched; each distinct name is looked up once."""
+        names = pd.Index(names)
+        distinct = names.unique()
+        codes = pd.Series([self.index.get(self.normalize(name)) if isinstance(name, str) else None for name in distinct],
+                          index=distinct, dtype=object)
+        return pd.Series(codes.reindex(names).to_numpy(), index=names, dtype=object)
+
+    def location_names(self, codes):
+        return [self.names.get(code) for code in codes]
+
+    def relabel(self, codes, default, locations):
+        """
+        Location names for the alpha-3 `codes`, in the spelling of `locations` when one of them
+        is the same country, so that joins with those locations match; `default` otherwise.
+        """
+        spelling = {}
+        for name, code in self.alpha_3(locations).dropna().items():
+            spelling.setdefault(code, name)
+        return [spelling.get(code, name) for code, name in zip(codes, default)]
+
+    def report(self, location_rows, regional_le, le_names):
+        """
+        Locations lost on either side of the join between the IHME data and the benchmarks.
+
+        Args:
+            location_rows (pd.Series): Row count per IHME location.
+            regional_le (pd.DataFrame): The (Year, Location) benchmark table the data is joined with.
+            le_names (list): Country names of LifeExpectancy.csv.
+
+        Returns:
+            pd.DataFrame: source, name, alpha-3, rows and reason of every dropped or unmatched name.
+        """
+        known = set(regional_le.index.get_level_values('Location'))
+        entries = []
+        ihme_codes = self.alpha_3(location_rows.index)
+        for name, rows in location_rows.items():
+            if rows and name not in known:
+                code = ihme_codes[name]
+                reason = 'no alias match' if code is None else 'no life expectancy'
+                entries.append(('IHME', name, code, int(rows), reason))
+        le_codes = self.alpha_3(le_names)
+        for name, code in le_codes.items():
+            if code is None:
+                entries.append(('LifeExpectancy.csv', name, None, None, 'no alias match'))
+            elif code not in self.countries.index or pd.isna(self.countries.at[code, 'region']):
+                entries.append(('LifeExpectancy.csv', name, code, None, 'no region, only a global benchmark'))
+        return pd.DataFrame(entries, columns=['source', 'name', 'alpha-3', 'rows', 'reason'])
@@ -0,0 +1,80 @@
+import itertools
+import os
+import pandas as pd
+from resolver import LocationResolver
+from utils import DATA_FOLDER, remap
+
+ROLLUP_FILE = os.path.join(DATA_FOLDER, 'rollups_aggregatedGDB.parquet')
+# Label of a dimension summed over; IHME's own totals are 'All ages', 'Both' and 'All causes'
+ALL = 'All'
+
+
+class RollupCube:
+    """
+    Pre-aggregated sums of the results over Location, Sex, Age and Cause, per Year.
+
+    Every combination of Sex, Age and Cause is stored both as is and summed over, with the
+    label 'All', at three geographic levels: Location, and the region and sub-region of
+    data/all.csv. Rows are (Year, Level, Area, Sex, Age, Cause), so the top-20 country ranking is
+    the slice Level='Location', Sex=Age=Cause='All', instead of a groupby over every result row.
+    Totals are plain sums of the rows, like the groupby sums they replace. Ratio columns do not
+    add up and are left out.
+    """
+    LEVELS = ['Location', 'region', 'sub-region']
+    DIMENSIONS = ['Sex', 'Age', 'Cause']
+
+    @staticmethod
+    def geography(locations):
+        """
+        region and sub-region of each of `locations`, matched to data/all.csv through LocationResolver.
+
+        Locations that match no country are printed and keep no region, so only their Location
+        rollups include them.
+        """
+        resolver = LocationResolver.load(os.path.join(DATA_FOLDER, 'all.csv'), remap)
+        codes = resolver.alpha_3(pd.Index(locations).unique())
+        unmatched = codes.index[codes.isna()]
+        if len(unmatched):
+            print(f'{len(unmatched)} locations match no country of all.csv and have no region: {", ".join(unmatched)}')
+        regions = resolver.countries[['region', 'sub-region']].reindex(codes.to_numpy())
+        regions.index = codes.index.rename('Location')
+        return regions
+
+    @staticmethod
+    def build(results, path=ROLLUP_FILE):
+        """
+        Materialize the rollups of Year-indexed results, as returned by Processor.process_measures.
+
+        Returns:
+            pd.DataFrame: The cube, also written to `path`.
+        """
+        columns = [c for c in results.columns if not c.startswith('AdjustRatio') and c != 'Counterfactual CF']
+        base = results[columns].reset_index()
+        base = base.astype({c: object for c in base.select_dtypes('category').columns}).drop(columns='region')
+        base = base.merge(RollupCube.geography(base['Location'].unique()), left_on='Location', right_index=True, how='left')
+
+        rollups = []
+        for level in RollupCube.LEVELS:
+            for kept in itertools.product([True, False], repeat=len(RollupCube.DIMENSIONS)):
+                dims = [dim for dim, keep in zip(RollupCube.DIMENSIONS, kept) if keep]
+                rollup = base.groupby(['Year', level] + dims)[columns].sum().reset_index()
+                rollup = rollup.rename(columns={level: 'Area'}).assign(Level=level)
+                rollups.append(rollup.assign(**{dim: ALL for dim in RollupCube.DIMENSIONS if dim not in dims}))
+        cube = pd.concat(rollups, ignore_index=True)[['Year', 'Level', 'Area'] + RollupCube.DIMENSIONS + columns]
+        cube = cube.sort_values(['Year', 'Level', 'Area'] + RollupCube.DIMENSIONS, ignore_index=True)
+        cube.to_parquet(path, index=False)
+        return cube
+
+    @staticmethod
+    def read(path=ROLLUP_FILE, columns=None, **selection):
+        """
+        One slice of the cube, e.g. read(Level='Location', Sex='All', Age='All', Cause='All', Year=2018).
+
+        Each keyword selects a value, or a list of values, of a key column; the selection is pushed
+        into the Parquet scan.
+        """
+        filters = [(key, 'in', list(value)) if isinstance(value, (list, tuple)) else (key, '==', value)
+                   for key, value in selection.items()]
+        if columns is not None:
+            columns = ['Year', 'Level', 'Area'] + RollupCube.DIMENSIONS + list(columns)
+        return pd.read_parquet(path, columns=columns, filters=filters or None)
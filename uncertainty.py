@@ -0,0 +1,228 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from processor import Processor
+
+# Half-width of a 95% interval in standard deviations of a normal distribution
+Z_95 = 1.959963984540054
+
+
+class UncertaintyProcessor:
+    """
+    Monte Carlo propagation of the IHME uncertainty intervals through the counterfactuals.
+
+    Each value is drawn from a normal distribution with the reported value as mean and
+    sd = (upper - lower) / (2 * 1.96), truncated at zero by drawing again below it. The Number
+    and Rate of a row share their draw, as the rate is the number over a fixed population;
+    Deaths and Prevalence are drawn independently. Every draw goes through the formulas of Processor._process_deaths and
+    Processor._process_other_measure, including the > 10 filters, and a row left out of a draw's
+    result counts as nothing avertable in that draw.
+
+    Rows are split into tasks along (Year, Sex, Age, Cause) blocks, which no benchmark group
+    crosses, and each task holds `draws` samples of at most about `task_rows` rows, filled
+    `batch_size` draws at a time. Tasks get their own seed from `seed`, so the intervals do not
+    depend on the worker count.
+    """
+    COLUMNS = Processor.COLUMNS + ['Lower', 'Upper']
+    PERCENTILES = (2.5, 50, 97.5)
+
+    @staticmethod
+    def simulate(data, measures, benchmark, draws=1000, percentiles=PERCENTILES, seed=0,
+                 workers=1, batch_size=100, task_rows=50_000):
+        """
+        Percentile intervals of the avertable burden of several measures.
+
+        Args:
+            data (pd.DataFrame or AggregatedView): Aggregated data with Lower and Upper columns,
+                e.g. a view of a store built with utils.process_file_bounds.
+            measures (list): The measures to process.
+            benchmark (str): 'global_benchmark' or 'regional_benchmark'.
+            draws (int): Number of Monte Carlo samples per value.
+            percentiles (tuple): Percentiles reported for each measure.
+
+        Returns:
+            pd.DataFrame: One 'Avertable {measure} p{q}' column per measure and percentile,
+                indexed like Processor.process_measures.
+        """
+        regional_le = Processor._benchmark_flags(data)
+        data = Processor._load_measures(data, measures, UncertaintyProcessor.COLUMNS)
+        # Cells without a row are -inf, told apart from NaN values as in Processor._wide
+        wide = (
+            data.set_index(Processor.year_keys(data) + Processor.ROW_KEYS + ['Measure', 'Metric'])[['Value', 'Lower', 'Upper']]
+            .unstack(['Measure', 'Metric'], fill_value=-np.inf)
+        )
+        wide, flags = Processor._attach_flags(wide, regional_le)
+        absent = wide['Value'].to_numpy() == -np.inf
+        names = wide['Value'].columns.get_level_values('Measure')
+        reported = {name: ~absent[:, names == name].all(axis=1) for name in names.unique()}
+        wide = wide.mask(wide == -np.inf)
+
+        frames, tasks = [], []
+        for measure in measures:
+            frame, inputs = UncertaintyProcessor._measure_inputs(wide, measure, flags, reported)
+            gpby = Processor._benchmark_groups(frame, benchmark)
+            groups = frame.groupby(gpby, observed=True, sort=False).ngroup().to_numpy()
+            blocks = frame.groupby([key for key in gpby if key != 'region'], observed=True, sort=False).ngroup().to_numpy()
+            bench = frame[benchmark].to_numpy(dtype=bool)
+            frames.append((measure, frame.index))
+            for rows in UncertaintyProcessor._split_rows(blocks, task_rows):
+                tasks.append((measure, {name: arrays[:, rows] for name, arrays in inputs.items()},
+                              groups[rows], bench[rows], rows))
+
+        seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+        args = [(measure, inputs, groups, bench, draws, batch_size, percentiles, task_seed)
+                for (measure, inputs, groups, bench, _), task_seed in zip(tasks, seeds)]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(tqdm(executor.map(_simulate_task, args), total=len(args)))
+        else:
+            results = [_simulate_task(task) for task in tqdm(args)]
+
+        outputs = []
+        for measure, index in frames:
+            intervals = np.full((len(index), len(percentiles)), np.nan)
+            for (task_measure, _, _, _, rows), result in zip(tasks, results):
+                if task_measure == measure:
+                    intervals[rows] = result.T
+            columns = [f'Avertable {measure} p{q:g}' for q in percentiles]
+            outputs.append(pd.DataFrame(intervals, index=index, columns=columns))
+        return pd.concat(outputs, axis=1).sort_index()
+
+    @staticmethod
+    def _measure_inputs(wide, measure, flags, reported):
+        """
+        The rows a measure's counterfactual can keep, with the benchmark `flags` of those rows,
+        and the (value, lower, upper) arrays of each of its inputs. `reported` tells, per IHME
+        measure, which rows of `wide` the data has.
+        """
+        names = Processor.source_measures(measure)
+        values = wide['Value']
+        if measure == 'Deaths':
+            reported = reported['Deaths'] & reported['Prevalence']
+        else:
+            # Rows at or below 10 stay in, as their draws can exceed it
+            reported = values[(measure, 'Number')].notna().to_numpy()
+        columns = [(field, name, metric) for name in names for metric in ['Number', 'Rate'] for field in ['Value', 'Lower', 'Upper']]
+        frame = wide.loc[reported, columns]
+        frame.columns = [' '.join(column) for column in columns]
+        frame = frame.join(flags.loc[reported])
+        inputs = {
+            f'{name} {metric}': np.stack([
+                frame[f'{field} {name} {metric}'].to_numpy(dtype='float64') for field in ['Value', 'Lower', 'Upper']
+            ])
+            for name in names for metric in ['Number', 'Rate']
+        }
+        return frame, inputs
+
+    @staticmethod
+    def _split_rows(blocks, task_rows):
+        """Row positions of each task: whole blocks, at most about `task_rows` rows per task."""
+        sizes = np.bincount(blocks)
+        block_tasks = (np.cumsum(sizes) - sizes) // task_rows
+        order = np.argsort(blocks, kind='stable')
+        row_tasks = block_tasks[blocks][order]
+        return np.split(order, np.flatnonzero(np.diff(row_tasks)) + 1)
+
+
+def _sd(lower, upper):
+    return np.nan_to_num((upper - lower) / (2 * Z_95))
+
+
+def _truncated_z(rng, shape, *inputs):
+    """
+    Standard normal draws of shape (draws, rows), drawn again wherever they would take any of
+    the `inputs` below zero, so that each input sampled with them follows its normal
+    distribution truncated at zero. Values are non-negative, so each round keeps at least
+    half of the draws still pending.
+    """
+    bound = np.full(shape[1], -np.inf)
+    for value, lower, upper in inputs:
+        sd = _sd(lower, upper)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bound = np.fmax(bound, np.where(sd > 0, -value / sd, -np.inf))
+    z = rng.standard_normal(shape)
+    pending = np.nonzero(z < bound)
+    while len(pending[0]):
+        z[pending] = rng.standard_normal(len(pending[0]))
+        redrawn = z[pending] < bound[pending[1]]
+        pending = (pending[0][redrawn], pending[1][redrawn])
+    return z
+
+
+def _draw(inputs, z):
+    """Samples of one input for the draws `z` of _truncated_z."""
+    value, lower, upper = inputs
+    # Only guards against rounding just below zero at the truncation point
+    return np.maximum(value + _sd(lower, upper) * z, 0)
+
+
+def _group_mean(values, members, groups, n_groups):
+    """
+    Per-draw mean of `values` over the member rows of each group, broadcast back to every row.
+
+    NaN values are skipped like pandas' mean. Also returns whether each row's group has any
+    member rows in the draw, which is what decides whether the inner join keeps the row.
+    """
+    n_draws = values.shape[0]
+    members = members & (groups >= 0)
+    flat = (np.arange(n_draws)[:, None] * n_groups + np.maximum(groups, 0)).ravel()
+    valid = members & ~np.isnan(values)
+    size = n_draws * n_groups
+    totals = np.bincount(flat, weights=np.where(valid, values, 0.0).ravel(), minlength=size)
+    counts = np.bincount(flat, weights=valid.ravel(), minlength=size)
+    present = np.bincount(flat, weights=members.ravel(), minlength=size) > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (totals / counts).reshape(n_draws, n_groups)
+    safe = np.maximum(groups, 0)
+    return means[:, safe], present.reshape(n_draws, n_groups)[:, safe] & (groups >= 0)
+
+
+def _deaths_draws(inputs, groups, n_groups, bench, rng, n_draws):
+    shape = (n_draws, len(groups))
+    z_deaths = _truncated_z(rng, shape, inputs['Deaths Number'], inputs['Deaths Rate'])
+    z_prevalence = _truncated_z(rng, shape, inputs['Prevalence Number'], inputs['Prevalence Rate'])
+    deaths, deaths_rate = _draw(inputs['Deaths Number'], z_deaths), _draw(inputs['Deaths Rate'], z_deaths)
+    prevalence = _draw(inputs['Prevalence Number'], z_prevalence)
+    prevalence_rate = _draw(inputs['Prevalence Rate'], z_prevalence)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = deaths_rate / prevalence_rate
+    cf, present = _group_mean(ratio, np.broadcast_to(bench, shape), groups, n_groups)
+    with np.errstate(invalid='ignore'):
+        kept = np.fmin(prevalence, deaths) > 10
+        avertable = deaths - prevalence * cf
+        avertable = np.where(avertable < 0, 0, avertable)
+    return np.where(kept & present, avertable, 0)
+
+
+def _other_measure_draws(measure, inputs, groups, n_groups, bench, rng, n_draws):
+    z = _truncated_z(rng, (n_draws, len(groups)), inputs[f'{measure} Number'], inputs[f'{measure} Rate'])
+    number, rate = _draw(inputs[f'{measure} Number'], z), _draw(inputs[f'{measure} Rate'], z)
+
+    with np.errstate(invalid='ignore'):
+        kept = number > 10
+    hic_mean_rate, present = _group_mean(rate, kept & bench, groups, n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.minimum(hic_mean_rate / rate, 1)
+    avertable = number - number * ratio
+    return np.where(kept & present, avertable, 0)
+
+
+def _simulate_task(args):
+    """Percentiles of the avertable burden of one task's rows, over all draws."""
+    measure, inputs, groups, bench, draws, batch_size, percentiles, seed = args
+    rng = np.random.default_rng(seed)
+    labels, groups = np.unique(groups, return_inverse=True)
+    if len(labels) and labels[0] == -1:
+        groups = groups - 1
+    n_groups = max(groups.max(initial=-1) + 1, 1)
+
+    samples = np.empty((draws, len(groups)))
+    for start in range(0, draws, batch_size):
+        n_draws = min(batch_size, draws - start)
+        if measure == 'Deaths':
+            samples[start:start + n_draws] = _deaths_draws(inputs, groups, n_groups, bench, rng, n_draws)
+        else:
+            samples[start:start + n_draws] = _other_measure_draws(measure, inputs, groups, n_groups, bench, rng, n_draws)
+    return np.nanpercentile(samples, percentiles, axis=0)
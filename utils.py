@@ -1,10 +1,16 @@
 import os
 import pandas as pd
-import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import seaborn as sns
 import zipfile
+import hashlib
+import inspect
+import json
+from pandas.api.types import union_categoricals
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from resolver import LocationResolver
 
 DOWNLOAD_FOLDER = './'
 DATA_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'data')
@@ -26,93 +32,294 @@ remap = {"Bolivia, Plurinational State of": 'Bolivia (Plurinational State of)',
                    'Venezuela, Bolivarian Republic of':'Venezuela (Bolivarian Republic of)'
                   }
 
-def load_regional_life_expectancy(year):
+def load_regional_life_expectancy(year, threshold=80, percentile=75):
+    """The benchmark flags of one year, indexed by Location; see regional_life_expectancy."""
+    return regional_life_expectancy([year], threshold, percentile).loc[year]
+
+def regional_life_expectancy(years, threshold=80, percentile=75, locations=None):
+    """
+    Region, life expectancy and benchmark flags of every country, for all years at once.
+
+    A country is a global benchmark with a life expectancy above `threshold`, and a regional
+    benchmark above the `percentile` of its region that year.
+
+    Returns:
+        pd.DataFrame: Indexed by (Year, Location), with region, alpha-3, LE, global_benchmark and regional_benchmark.
+    """
+    return benchmark_table(years, [
+        {'name': 'global_benchmark', 'scope': 'global', 'threshold': threshold},
+        {'name': 'regional_benchmark', 'scope': 'regional', 'percentile': percentile},
+    ], locations)
+
+def benchmark_table(years, benchmarks, locations=None):
+    """
+    Benchmark membership of every country and year under several benchmark definitions.
+
+    Each definition is a dict with a 'name' and a 'scope'. With scope 'global' the benchmark
+    countries have a life expectancy above 'threshold' (80 by default); with scope 'regional',
+    above the 'percentile' (75 by default) of their region that year. Both files are read once.
+
+    Countries are matched to all.csv through LocationResolver, and named after the spelling
+    they have in `locations`, e.g. the IHME locations, when given.
+
+    Returns:
+        pd.DataFrame: Indexed by (Year, Location), with the region, alpha-3, LE and one boolean column per definition.
+    """
     LE_path = os.path.join(DATA_FOLDER, 'LifeExpectancy.csv')
     regional_path = os.path.join(DATA_FOLDER, 'all.csv')
-    
-    le_benchmarks = pd.read_csv(LE_path, index_col='Country Name')[str(year)]
-    regions = pd.read_csv(regional_path,index_col=0)
-    
-    regional_le = regions[['region']].merge(le_benchmarks,left_index=True,right_index=True)
-    regional_le['regional_75'] = regional_le.groupby('region').transform(lambda x: np.percentile(x,75))
-    regional_le['global_benchmark'] = regional_le[str(year)] > 80
-    regional_le['regional_benchmark'] = regional_le[str(year)] > regional_le['regional_75']
-    regional_le.index = [remap[x] if x in remap else x for x in regional_le.index]
-    return regional_le
+
+    le_benchmarks = pd.read_csv(LE_path, index_col='Country Name')[[str(year) for year in years]]
+    resolver = LocationResolver.load(regional_path, remap)
+
+    le_benchmarks['alpha-3'] = resolver.alpha_3(le_benchmarks.index).to_numpy()
+    le_benchmarks = le_benchmarks.dropna(subset=['alpha-3']).drop_duplicates('alpha-3')
+    regional_le = le_benchmarks.merge(resolver.countries[['region']], left_on='alpha-3', right_index=True)
+    names = resolver.location_names(regional_le['alpha-3'])
+    if locations is not None:
+        names = resolver.relabel(regional_le['alpha-3'], names, locations)
+    regional_le.index = names
+    regional_le = regional_le.melt(id_vars=['region', 'alpha-3'], var_name='Year', value_name='LE', ignore_index=False)
+    regional_le['Year'] = regional_le['Year'].astype(int)
+    regional_le = regional_le.rename_axis('Location').set_index('Year', append=True).swaplevel()
+
+    table = regional_le[['region', 'alpha-3', 'LE']].copy()
+    by_region = regional_le.groupby([regional_le.index.get_level_values('Year'), 'region'])['LE']
+    # Like np.percentile, a region with a missing life expectancy has no percentile
+    complete = by_region.transform('count') == by_region.transform('size')
+    for benchmark in benchmarks:
+        if benchmark['scope'] == 'global':
+            table[benchmark['name']] = regional_le['LE'] > benchmark.get('threshold', 80)
+        else:
+            percentile = by_region.transform('quantile', benchmark.get('percentile', 75) / 100)
+            table[benchmark['name']] = regional_le['LE'] > percentile.where(complete)
+    return table.sort_index()
+
+@contextmanager
+def open_source(source):
+    """Open a CSV path, or a (zip path, member) pair decompressed on the fly as it is read."""
+    if isinstance(source, tuple):
+        zip_path, member = source
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref, zip_ref.open(member) as stream:
+            yield stream
+    else:
+        with open(source, 'rb') as stream:
+            yield stream
+
+# Only these columns of the IHME exports are parsed; bounds and ID columns are never read
+SOURCE_DTYPES = {
+    'measure': 'category',
+    'location': 'category',
+    'sex': 'category',
+    'age': 'category',
+    'cause': 'category',
+    'metric': 'category',
+    'year': 'int16',
+    'val': 'float64',
+}
+# Uncertainty bounds, read only by the uncertainty mode
+BOUND_DTYPES = {'lower': 'float32', 'upper': 'float32'}
+CHUNK_SIZE = 500_000
+
+def concat_frames(frames):
+    """Concatenate frames, unioning their sorted categories so categorical columns stay categorical."""
+    frames = list(frames)
+    for column in frames[0].select_dtypes('category').columns:
+        categories = union_categoricals([frame[column] for frame in frames], ignore_order=True).categories
+        dtype = pd.CategoricalDtype(sorted(categories))
+        frames = [frame.astype({column: dtype}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+def read_source(source, years, chunksize=CHUNK_SIZE, bounds=False):
+    """
+    Read the rows of the given years from one IHME export in bounded memory.
+
+    The file is parsed `chunksize` rows at a time, with only the needed columns and compact
+    dtypes, and rows of other years are dropped from each chunk before the next one is read.
+    The lower/upper bounds are only read with `bounds=True`.
+    """
+    dtypes = {**SOURCE_DTYPES, **BOUND_DTYPES} if bounds else SOURCE_DTYPES
+    with open_source(source) as stream:
+        chunks = pd.read_csv(stream, usecols=list(dtypes), dtype=dtypes, chunksize=chunksize)
+        kept = [chunk[chunk['year'].isin(years)] for chunk in chunks]
+    return concat_frames(kept)
 
 def process_file(file_path, year):
     """Process a single CSV file and return a cleaned DataFrame."""
-    df = pd.read_csv(file_path)
-    return df.query("year == @year")[['measure', 'location', 'sex', 'age', 'cause', 'metric', 'val']]
+    df = read_source(file_path, [year])
+    return df[['measure', 'location', 'sex', 'age', 'cause', 'metric', 'val']]
+
+def process_file_years(file_path, years):
+    """Process a single CSV file once, keeping the rows of every requested year."""
+    df = read_source(file_path, years)
+    return df[['measure', 'location', 'sex', 'age', 'cause', 'metric', 'val', 'year']]
+
+def process_file_bounds(file_path, years):
+    """Like process_file_years, also keeping the lower and upper bounds of every value."""
+    df = read_source(file_path, years, bounds=True)
+    return df[['measure', 'location', 'sex', 'age', 'cause', 'metric', 'val', 'year', 'lower', 'upper']]
 
     # Function to create a separate figure for each top N and measure
-def create_figure_for_top_n_and_measure(data, countries, top_n, measure,PLOT_FOLDER, output_file_prefix):
-    fig, axs = plt.subplots(1, 2, figsize=(20, 12), sharey=True)
+def create_figure_for_top_n_and_measure(data, countries, top_n, measure,PLOT_FOLDER, output_file_prefix, causes=None, aggregates=None,
+                                        years=(2018, 2021), layout=None, countries_label='Top 20 Countries'):
+    # One subplot per year; layout may set the figsize and the number of legend columns
+    layout = layout or {}
+    fig, axs = plt.subplots(1, len(years), figsize=tuple(layout.get('figsize', (20, 12))), sharey=True, squeeze=False)
+    axs = axs[0]
 
     # Define colors for causes, ensuring each cause has a unique color
     cause_colors = {
         'COVID-19': '#ff6666',  # Red for COVID-19
     }
-    # Generate additional colors for other causes
+    # Generate additional colors for other causes, in the order of `causes` when data is only a slice
     default_colors = list(mcolors.TABLEAU_COLORS.values()) + list(mcolors.CSS4_COLORS.values())
-    for i, cause in enumerate(data['Cause'].unique()):
+    for i, cause in enumerate(data['Cause'].unique() if causes is None else causes):
         if cause not in cause_colors:
             cause_colors[cause] = default_colors[i % len(default_colors)]
 
 
-    # Plot for 2018
-    plot_avertable_by_condition(data, 2018, countries, top_n, axs[0], cause_colors, measure)
+    # Reuse the cause matrices shared by every top N of this measure when given
+    aggregates = aggregates or {}
 
-    # Plot for 2021 using the same countries as 2018
-    plot_avertable_by_condition(data, 2021, countries, top_n, axs[1], cause_colors, measure)
+    # Plot every year for the same countries
+    for ax, year in zip(axs, years):
+        plot_avertable_by_condition(data, year, countries, top_n, ax, cause_colors, measure, aggregates.get(year), countries_label)
 
     # Create a single legend below the subplots
     handles, labels = axs[0].get_legend_handles_labels()  # Get legend handles and labels
-    fig.legend(handles, labels, loc='lower center', ncol=5, title="Causes")
+    fig.legend(handles, labels, loc='lower center', ncol=layout.get('legend_ncol', 5), title="Causes")
 
     # Remove legends from individual subplots
-    axs[0].get_legend().remove()
-    axs[1].get_legend().remove()
+    for ax in axs:
+        ax.get_legend().remove()
 
     # Adjust layout and save the figure
     plt.tight_layout()
-    plt.savefig(os.path.join(PLOT_FOLDER,f'{output_file_prefix}_top_{top_n}_{measure}_2018_2021.png'))
+    output_file = figure_file(PLOT_FOLDER, output_file_prefix, top_n, measure, years)
+    plt.savefig(output_file)
     plt.close()
+    return output_file
 
+def figure_file(PLOT_FOLDER, output_file_prefix, top_n, measure, years=(2018, 2021)):
+    return os.path.join(PLOT_FOLDER,f'{output_file_prefix}_top_{top_n}_{measure}_{"_".join(str(year) for year in years)}.png')
 
-# Define function to calculate and plot percentage distributions for a given measure
-def plot_avertable_by_condition(data, year, countries, top_n, ax, colors, measure):
+def _figure_arguments(job):
+    """The arguments of create_figure_for_top_n_and_measure for a job tuple, defaults included."""
+    arguments = inspect.signature(create_figure_for_top_n_and_measure).bind(*job)
+    arguments.apply_defaults()
+    return arguments.arguments
+
+def figure_fingerprint(job):
+    """
+    Hash of everything a figure depends on: its data slice, countries, top N, measure, output
+    name, cause colour order, the plotted years, the layout and the plotting code.
+    """
+    args = _figure_arguments(job)
+    data = args['data']
+    causes = data['Cause'].unique() if args['causes'] is None else args['causes']
+    digest = hashlib.sha256()
+    digest.update(json.dumps(list(data.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+    digest.update(json.dumps({
+        'countries': list(args['countries']), 'top_n': args['top_n'], 'measure': args['measure'],
+        'prefix': args['output_file_prefix'], 'causes': list(causes), 'years': list(args['years']),
+        'layout': args['layout'], 'label': args['countries_label'],
+    }, default=str).encode())
+    for func in (create_figure_for_top_n_and_measure, plot_avertable_by_condition, cause_matrix):
+        digest.update(inspect.getsource(func).encode())
+    return digest.hexdigest()
+
+def _init_render_worker():
+    plt.switch_backend('Agg')
+
+def _render_figure(job):
+    return create_figure_for_top_n_and_measure(*job)
+
+def render_figures(jobs, workers=1, index_file=None, prune=False):
+    """
+    Render create_figure_for_top_n_and_measure for each tuple of arguments in `jobs`.
+
+    With workers > 1 the figures are rendered across a process pool on the headless Agg
+    backend, each job only carrying its own slice of the data.
+
+    With an `index_file`, a JSON map of figure file to figure_fingerprint kept next to the
+    figures, a figure whose file exists with the same fingerprint is not rendered again.
+    Entries of deleted figures are dropped, and with `prune` so are the figures of the folder
+    that this batch no longer produces. Returns the files of every job.
+    """
+    files = []
+    for job in jobs:
+        args = _figure_arguments(job)
+        files.append(figure_file(args['PLOT_FOLDER'], args['output_file_prefix'], args['top_n'], args['measure'], args['years']))
+    if index_file is None:
+        pending, index = list(range(len(jobs))), None
+    else:
+        index = {}
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+        folder = os.path.dirname(index_file)
+        index = {name: fp for name, fp in index.items() if os.path.exists(os.path.join(folder, name))}
+        fingerprints = [figure_fingerprint(job) for job in jobs]
+        pending = [i for i, (file, fp) in enumerate(zip(files, fingerprints)) if index.get(os.path.basename(file)) != fp]
+
+    pending_jobs = [jobs[i] for i in pending]
+    if workers > 1 and len(pending_jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker) as executor:
+            list(executor.map(_render_figure, pending_jobs))
+    else:
+        for job in pending_jobs:
+            _render_figure(job)
+
+    if index is not None:
+        for i in pending:
+            index[os.path.basename(files[i])] = fingerprints[i]
+        if prune:
+            current = {os.path.basename(file) for file in files}
+            for name in [name for name in index if name not in current]:
+                os.remove(os.path.join(folder, name))
+                del index[name]
+        with open(index_file, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+    return files
+
+
+def cause_matrix(data, year, countries, measure):
+    """
+    Location × Cause totals of a measure for one year and set of countries, and the causes
+    ranked by their total. Every top N of plot_avertable_by_condition is a slice of these.
+    """
     # Filter data for the specified year, countries, and measure
     filtered_data = data[
         (data['Year'] == year) & (data['Location'].isin(countries))
     ]
     filtered_data = filtered_data.dropna(subset=measure,axis=0)
 
-    # Group by cause to calculate total for the given measure
-    top_causes = (
+    # Group by cause to rank causes by total for the given measure
+    ranking = (
         filtered_data.groupby('Cause')[measure]
         .sum()
         .sort_values(ascending=False)
-        .head(top_n)
         .index
     )
+    # Group by country and cause to get total for the measure; NaN where a country has no row of a cause
+    matrix = filtered_data.groupby(['Location', 'Cause'])[measure].sum().unstack()
+    return matrix, ranking
 
-    # Filter for the top N causes
-    filtered_data = filtered_data[filtered_data['Cause'].isin(top_causes)]
+# Define function to calculate and plot percentage distributions for a given measure
+def plot_avertable_by_condition(data, year, countries, top_n, ax, colors, measure, aggregate=None, countries_label='Top 20 Countries'):
+    matrix, ranking = aggregate if aggregate is not None else cause_matrix(data, year, countries, measure)
+
+    # Keep the top N causes, and the countries with any row of them
+    top_causes = ranking[:top_n]
+    cause_distribution = matrix.loc[:, matrix.columns.isin(top_causes)].dropna(how='all').fillna(0)
 
     # Add COVID-19 if not already in the data for consistency
-    if 'COVID-19' not in filtered_data['Cause'].unique():
-        filtered_data = pd.concat([
-            filtered_data,
-            pd.DataFrame({'Year': [year], 'Location': [countries[0]], 'Cause': ['COVID-19'], measure: [0]})
-        ])
-
-    # Group by country and cause to get total for the measure
-    cause_distribution = (
-        filtered_data.groupby(['Location', 'Cause'])[measure]
-        .sum()
-        .unstack(fill_value=0)
-    )
+    if 'COVID-19' not in top_causes:
+        if countries[0] not in cause_distribution.index:
+            cause_distribution.loc[countries[0]] = 0.0
+            cause_distribution = cause_distribution.sort_index()
+        cause_distribution['COVID-19'] = 0.0
+        cause_distribution = cause_distribution[cause_distribution.columns.sort_values()]
 
     # Normalize to get percentages
     cause_percentages = cause_distribution.div(cause_distribution.sum(axis=1), axis=0) * 100
@@ -124,7 +331,7 @@ def plot_avertable_by_condition(data, year, countries, top_n, ax, colors, measur
     # Plot the stacked bar chart
     cause_percentages = cause_percentages[cause_percentages.columns.sort_values()]  # Sort causes alphabetically
     cause_percentages.plot(kind='bar', stacked=True, ax=ax, color=[colors.get(cause, '#cccccc') for cause in cause_percentages.columns])
-    ax.set_title(f'Top {top_n} Causes of {measure} (Top 20 Countries, {year})')
+    ax.set_title(f'Top {top_n} Causes of {measure} ({countries_label}, {year})')
     ax.set_ylabel(f'Rateage of {measure}')
     ax.set_xlabel('Country')
     ax.tick_params(axis='x', rotation=90)